@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+#
+# deepzoom_async - Asyncio front end for deepzoom_multiserver
+#
+# Serves the Deep Zoom endpoints (.dzi and tiles) from an aiohttp event loop.
+# Tiles are loaded in a thread pool, concurrent requests for the same tile
+# share one render, and renders still queued when all their clients have
+# disconnected are cancelled. Other pages are served by the Flask app, called
+# as a WSGI application with the request and response headers passed through.
+#
+
+from aiohttp import web
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from openslide import OpenSlideError
+from io import BytesIO
+from multidict import CIMultiDict
+from optparse import OptionParser
+import sys
+
+import deepzoom_multiserver as dz_server
+from deepzoom_multiserver import _TileCache, app as flask_app
+
+TILE_WORKERS = 8
+
+
+class _TileRenders(object):
+    '''Tile loads in flight, shared by all the requests for the same tile.'''
+
+    def __init__(self, executor):
+        self.executor = executor
+        self._inflight = {}
+
+    async def get(self, key, *args):
+        entry = self._inflight.get(key)
+        if entry is None or entry[0].cancelled():
+            loop = asyncio.get_running_loop()
+            future = loop.run_in_executor(self.executor, dz_server._load_tile,
+                    *args)
+            entry = self._inflight[key] = [future, 0]
+
+            def _done(_, key=key, entry=entry):
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+            future.add_done_callback(_done)
+
+        future = entry[0]
+        entry[1] += 1
+        try:
+            data = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            entry[1] -= 1
+            if not entry[1]:
+                # No client is waiting anymore: drop the render if not started.
+                # Forget it now, before _done runs, so a new request for the
+                # same tile does not await the cancelled future.
+                if self._inflight.get(key) is entry:
+                    del self._inflight[key]
+                future.cancel()
+            raise
+        entry[1] -= 1
+        return data
+
+
+def _slide_path(path):
+    slide_path = dz_server._resolve_path(path)
+    if slide_path is None:
+        raise web.HTTPNotFound()
+    return slide_path
+
+
+async def dzi(request):
+    path = request.match_info['path']
+    slide_path = _slide_path(path)
+    loop = asyncio.get_running_loop()
+    try:
+        slide = await loop.run_in_executor(request.app['executor'],
+                flask_app.cache.get, slide_path)
+    except OpenSlideError:
+        raise web.HTTPNotFound()
+    return web.Response(text=slide.get_dzi(flask_app.config['DEEPZOOM_FORMAT']),
+            content_type='application/xml')
+
+
+async def tile(request):
+    path = request.match_info['path']
+    level, col, row = (int(request.match_info[k])
+            for k in ('level', 'col', 'row'))
+    format = request.match_info['format'].lower()
+    if format != 'jpeg' and format != 'png':
+        # Not supported by Deep Zoom
+        raise web.HTTPNotFound()
+    slide_path = _slide_path(path)
+    key = dz_server._tile_key(slide_path, level, col, row, format)
+    etag = _TileCache.etag(key)
+    headers = {
+        'ETag': '"%s"' % etag,
+        'Cache-Control': 'public, max-age=%d' %
+                flask_app.config['TILE_CACHE_MAX_AGE'],
+    }
+    if any(e.value == etag for e in request.if_none_match or ()):
+        return web.Response(status=304, headers=headers)
+    try:
+        data = await request.app['renders'].get(key, path, slide_path, key)
+    except (ValueError, OpenSlideError):
+        # Invalid level or coordinates, or unreadable slide
+        raise web.HTTPNotFound()
+    return web.Response(body=data, content_type='image/%s' % format,
+            headers=headers)
+
+
+# Set by aiohttp from the body it sends
+_SKIP_HEADERS = ('content-length', 'transfer-encoding', 'connection')
+
+
+def _wsgi_environ(request, body):
+    environ = {
+        'REQUEST_METHOD': request.method,
+        'SCRIPT_NAME': '',
+        # WSGI strings are the raw bytes decoded as latin-1
+        'PATH_INFO': request.path.encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': request.query_string,
+        'SERVER_NAME': request.url.host or '',
+        'SERVER_PORT': str(request.url.port or ''),
+        'SERVER_PROTOCOL': 'HTTP/%d.%d' % request.version,
+        'REMOTE_ADDR': request.remote or '',
+        'CONTENT_TYPE': request.headers.get('Content-Type', ''),
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': request.scheme,
+        'wsgi.input': BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    for name, value in request.headers.items():
+        if name.lower() in ('content-type', 'content-length'):
+            continue
+        key = 'HTTP_' + name.upper().replace('-', '_')
+        environ[key] = environ[key] + ',' + value if key in environ else value
+    return environ
+
+
+def _call_wsgi(wsgi_app, environ):
+    '''Runs a WSGI application, returns (status, headers, body).'''
+    response = []
+    chunks = []
+
+    def start_response(status, headers, exc_info=None):
+        response[:] = [status, headers]
+        return chunks.append
+
+    result = wsgi_app(environ, start_response)
+    try:
+        for chunk in result:
+            chunks.append(chunk)
+    finally:
+        if hasattr(result, 'close'):
+            result.close()
+    status, headers = response
+    return int(status.split(' ', 1)[0]), headers, b''.join(chunks)
+
+
+async def flask_page(request):
+    '''Index, slide pages and static files, from the Flask app.'''
+    body = await request.read()
+    loop = asyncio.get_running_loop()
+    status, headers, data = await loop.run_in_executor(
+            request.app['executor'], _call_wsgi, flask_app,
+            _wsgi_environ(request, body))
+    return web.Response(status=status, body=data, headers=CIMultiDict(
+            (name, value) for name, value in headers
+            if name.lower() not in _SKIP_HEADERS))
+
+
+def create_app(workers=TILE_WORKERS):
+    dz_server._setup()
+    executor = ThreadPoolExecutor(workers)
+    aio_app = web.Application()
+    aio_app['executor'] = executor
+    aio_app['renders'] = _TileRenders(executor)
+    aio_app.router.add_get(
+            r'/{path:.+}_files/{level:\d+}/{col:\d+}_{row:\d+}.{format}', tile)
+    aio_app.router.add_get(r'/{path:.+}.dzi', dzi)
+    aio_app.router.add_route('*', r'/{tail:.*}', flask_page)
+    return aio_app
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='Usage: %prog [options] [slide-directory]')
+    parser.add_option('-c', '--config', metavar='FILE', dest='config',
+                help='config file')
+    parser.add_option('-j', '--jobs', metavar='COUNT', dest='workers',
+                type='int', default=TILE_WORKERS,
+                help='tile rendering threads [%d]' % TILE_WORKERS)
+    parser.add_option('-l', '--listen', metavar='ADDRESS', dest='host',
+                default='127.0.0.1',
+                help='address to listen on [127.0.0.1]')
+    parser.add_option('-p', '--port', metavar='PORT', dest='port',
+                type='int', default=5000,
+                help='port to listen on [5000]')
+    parser.add_option('-P', '--pyramid-dir', metavar='DIR',
+                dest='PYRAMID_DIR',
+                help='directory of tiles pre-rendered by deepzoom_pyramid')
+
+    (opts, args) = parser.parse_args()
+    # Load config file if specified
+    if opts.config is not None:
+        flask_app.config.from_pyfile(opts.config)
+    # Overwrite only those settings specified on the command line
+    for k in dir(opts):
+        if not k.startswith('_') and getattr(opts, k) is None:
+            delattr(opts, k)
+    flask_app.config.from_object(opts)
+    # Set slide directory
+    try:
+        flask_app.config['SLIDE_DIR'] = args[0]
+    except IndexError:
+        pass
+
+    # Handlers are cancelled when their client disconnects
+    web.run_app(create_app(opts.workers), host=opts.host, port=opts.port,
+            handler_cancellation=True)
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+#
+# deepzoom_benchmark - Load test of deepzoom_multiserver
+#
+# Starts the server with an increasing number of worker processes and the tile
+# cache disabled, requests random tiles from many client threads and reports
+# tiles/s and latency percentiles for each worker count.
+#
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+from optparse import OptionParser
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from openslide import OpenSlide
+from openslide.deepzoom import DeepZoomGenerator
+
+from deepzoom_multiserver import app
+from deepzoom_pyramid import _find_slides
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        'deepzoom_multiserver.py')
+
+
+def _tile_urls(slide_dir, count, seed=0):
+    '''Random tile urls of the largest levels of every slide.'''
+    config_map = {
+        'DEEPZOOM_TILE_SIZE': 'tile_size',
+        'DEEPZOOM_OVERLAP': 'overlap',
+        'DEEPZOOM_LIMIT_BOUNDS': 'limit_bounds',
+    }
+    dz_opts = dict((v, app.config[k]) for k, v in config_map.items())
+    format = app.config['DEEPZOOM_FORMAT']
+
+    tiles = []
+    for relpath in _find_slides(slide_dir):
+        dz = DeepZoomGenerator(OpenSlide(os.path.join(slide_dir, relpath)),
+                **dz_opts)
+        for level in range(max(dz.level_count - 3, 0), dz.level_count):
+            cols, rows = dz.level_tiles[level]
+            tiles.extend('/%s_files/%d/%d_%d.%s' % (relpath, level, col, row,
+                    format) for col in range(cols) for row in range(rows))
+
+    rand = random.Random(seed)
+    return [rand.choice(tiles) for _ in range(count)]
+
+
+def _fetch(url):
+    start = time.time()
+    with urlopen(url) as resp:
+        resp.read()
+    return time.time() - start
+
+
+def _wait_for_server(base_url, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            urlopen(base_url + '/').read()
+            return
+        except HTTPError:
+            return
+        except URLError:
+            time.sleep(0.2)
+    raise RuntimeError('Server at %s did not start' % base_url)
+
+
+def benchmark(slide_dir, workers, urls, concurrency=16, port=5050):
+    '''Runs the server with the given number of workers and fetches urls from
+    concurrency client threads. Returns (tiles/s, p50, p99) in seconds.'''
+    with tempfile.NamedTemporaryFile('w', suffix='.py', delete=False) as f:
+        f.write('TILE_CACHE_SIZE = 0\n')
+        settings = f.name
+    env = dict(os.environ, DEEPZOOM_MULTISERVER_SETTINGS=settings)
+    server = subprocess.Popen([sys.executable, SERVER, '-p', str(port),
+            '-w', str(workers), slide_dir], env=env)
+    base_url = 'http://127.0.0.1:%d' % port
+    try:
+        _wait_for_server(base_url)
+        # Warm up the slide handles of every worker
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(_fetch, [base_url + url
+                    for url in urls[:concurrency * workers]]))
+
+        start = time.time()
+        with ThreadPoolExecutor(concurrency) as executor:
+            latencies = sorted(executor.map(_fetch,
+                    [base_url + url for url in urls]))
+        elapsed = time.time() - start
+    finally:
+        server.terminate()
+        server.wait()
+        os.remove(settings)
+
+    p50 = latencies[len(latencies) // 2]
+    p99 = latencies[min(int(len(latencies) * 0.99), len(latencies) - 1)]
+    return len(urls) / elapsed, p50, p99
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='Usage: %prog [options] slide-directory')
+    parser.add_option('-w', '--workers', metavar='LIST', dest='workers',
+                default='1,2,4',
+                help='comma separated worker counts to test [1,2,4]')
+    parser.add_option('-n', '--requests', metavar='COUNT', dest='requests',
+                type='int', default=2000,
+                help='tile requests per run [2000]')
+    parser.add_option('-C', '--concurrency', metavar='COUNT',
+                dest='concurrency', type='int', default=16,
+                help='concurrent client threads [16]')
+    parser.add_option('-p', '--port', metavar='PORT', dest='port',
+                type='int', default=5050,
+                help='port for the benchmarked server [5050]')
+
+    (opts, args) = parser.parse_args()
+    try:
+        slide_dir = args[0]
+    except IndexError:
+        parser.error('Missing slide directory argument')
+
+    urls = _tile_urls(slide_dir, opts.requests)
+    print('%8s %10s %10s %10s' % ('workers', 'tiles/s', 'p50 (ms)',
+            'p99 (ms)'))
+    for workers in [int(w) for w in opts.workers.split(',')]:
+        tiles_per_sec, p50, p99 = benchmark(slide_dir, workers, urls,
+                opts.concurrency, opts.port)
+        print('%8d %10.1f %10.1f %10.1f' % (workers, tiles_per_sec,
+                p50 * 1000, p99 * 1000))
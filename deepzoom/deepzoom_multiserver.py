@@ -19,14 +19,20 @@
 #
 
 from collections import OrderedDict
-from flask import Flask, abort, make_response, render_template, url_for
+from flask import Flask, abort, make_response, render_template, request, url_for
+import hashlib
 from io import BytesIO
+import json
 import openslide
 from openslide import OpenSlide, OpenSlideError
 from openslide.deepzoom import DeepZoomGenerator
 import os
 from optparse import OptionParser
-from threading import Lock
+import signal
+import socket
+from threading import Event, Lock, Thread
+import time
+from werkzeug.serving import make_server
 
 SLIDE_DIR = '.'
 SLIDE_CACHE_SIZE = 10
@@ -35,6 +41,12 @@ DEEPZOOM_TILE_SIZE = 254
 DEEPZOOM_OVERLAP = 1
 DEEPZOOM_LIMIT_BOUNDS = True
 DEEPZOOM_TILE_QUALITY = 75
+TILE_CACHE_SIZE = 256
+TILE_CACHE_DIR = None
+TILE_CACHE_MAX_AGE = 3600
+CATALOG_REFRESH = 60
+SLIDE_CATALOG = None
+PYRAMID_DIR = None
 
 app = Flask(__name__)
 app.config.from_object(__name__)
@@ -53,6 +65,7 @@ class _SlideCache(object):
         self.dz_opts = dz_opts
         self._lock = Lock()
         self._cache = OrderedDict()
+        self._slide_locks = {}
 
     def get(self, path):
         with self._lock:
@@ -61,7 +74,22 @@ class _SlideCache(object):
                 slide = self._cache.pop(path)
                 self._cache[path] = slide
                 return slide
+            slide_lock = self._slide_locks.setdefault(path, Lock())
 
+        # Concurrent requests for a slide not yet open wait for a single open
+        with slide_lock:
+            with self._lock:
+                if path in self._cache:
+                    return self._cache[path]
+            slide = self._open(path)
+            with self._lock:
+                if len(self._cache) == self.cache_size:
+                    evicted, _ = self._cache.popitem(last=False)
+                    self._slide_locks.pop(evicted, None)
+                self._cache[path] = slide
+        return slide
+
+    def _open(self, path):
         osr = OpenSlide(path)
         slide = DeepZoomGenerator(osr, **self.dz_opts)
         try:
@@ -70,38 +98,196 @@ class _SlideCache(object):
             slide.mpp = (float(mpp_x) + float(mpp_y)) / 2
         except (KeyError, ValueError):
             slide.mpp = 0
+        return slide
+
+
+class _TileCache(object):
+    '''LRU cache of encoded tiles bounded by size in bytes, optionally backed
+    by a directory of tile files.'''
+
+    def __init__(self, max_bytes, cache_dir=None):
+        self.max_bytes = max_bytes
+        self.cache_dir = cache_dir
+        self._lock = Lock()
+        self._cache = OrderedDict()
+        self._bytes = 0
+
+    @staticmethod
+    def etag(key):
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+    def _disk_path(self, etag, format):
+        return os.path.join(self.cache_dir, etag[:2], '%s.%s' % (etag, format))
 
+    def _put_memory(self, key, data):
         with self._lock:
-            if path not in self._cache:
-                if len(self._cache) == self.cache_size:
-                    self._cache.popitem(last=False)
-                self._cache[path] = slide
+            if key in self._cache:
+                return
+            self._cache[key] = data
+            self._bytes += len(data)
+            while self._bytes > self.max_bytes and self._cache:
+                _, evicted = self._cache.popitem(last=False)
+                self._bytes -= len(evicted)
+
+    def get(self, key):
+        with self._lock:
+            if key in self._cache:
+                # Move to end of LRU
+                data = self._cache.pop(key)
+                self._cache[key] = data
+                return data
+
+        if self.cache_dir is None:
+            return None
+        try:
+            with open(self._disk_path(self.etag(key), key[5]), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        self._put_memory(key, data)
+        return data
+
+    def put(self, key, data):
+        self._put_memory(key, data)
+
+        if self.cache_dir is not None:
+            path = self._disk_path(self.etag(key), key[5])
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = '%s.%d.tmp' % (path, os.getpid())
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+
+
+class _SlideCatalog(object):
+    '''Tree of the slides under basedir with their metadata, built in a
+    background thread and rescanned every refresh seconds. Only directories
+    whose mtime changed are listed again and only new or modified slides are
+    reopened. Slides found unchanged in the seed catalog (a slide_catalog.json
+    written by wsi.catalog) are not opened at all.'''
+
+    def __init__(self, basedir, refresh=60, seed_path=None):
+        self.basedir = basedir
+        self.refresh = refresh
+        self._seed = {}
+        if seed_path is not None:
+            with open(seed_path) as f:
+                self._seed = json.load(f)
+        self.root = _Directory('', [])
+        self.ready = Event()
+        self._dirs = {}
+        self._slides = {}
+        thread = Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.rescan()
+            except Exception:
+                # Keep the previous tree and retry on the next refresh
+                app.logger.exception('Slide catalog scan failed')
+            finally:
+                self.ready.set()
+            time.sleep(self.refresh)
+
+    def rescan(self):
+        dirs, slides = {}, {}
+        root = self._scan('', dirs, slides)
+        # Swap everything at once so readers never see a partial scan
+        self.root, self._dirs, self._slides = root, dirs, slides
+
+    def _scan(self, relpath, dirs, slides):
+        path = os.path.join(self.basedir, relpath)
+        mtime = os.stat(path).st_mtime
+        if relpath in self._dirs and self._dirs[relpath][0] == mtime:
+            _, subdirs, files = self._dirs[relpath]
+        else:
+            subdirs, files = [], []
+            for name in sorted(os.listdir(path)):
+                cur_relpath = os.path.join(relpath, name)
+                cur_path = os.path.join(self.basedir, cur_relpath)
+                if os.path.isdir(cur_path):
+                    subdirs.append(cur_relpath)
+                elif (cur_relpath in self._slides or
+                        OpenSlide.detect_format(cur_path)):
+                    files.append(cur_relpath)
+        dirs[relpath] = (mtime, subdirs, files)
+
+        children = []
+        for cur_relpath in subdirs:
+            cur_dir = self._scan(cur_relpath, dirs, slides)
+            if cur_dir.children:
+                children.append(cur_dir)
+        for cur_relpath in files:
+            slide = self._slide(cur_relpath)
+            if slide is not None:
+                slides[cur_relpath] = slide
+                children.append(slide)
+        return _Directory(os.path.basename(relpath), children)
+
+    def _slide(self, relpath):
+        path = os.path.join(self.basedir, relpath)
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        slide = self._slides.get(relpath)
+        if (slide is not None and slide.mtime == st.st_mtime and
+                slide.size == st.st_size):
+            return slide
+        info = self._seed.get(os.path.basename(relpath))
+        if (info is not None and info['mtime'] == st.st_mtime and
+                info['file_size'] == st.st_size):
+            return _SlideFile(relpath,
+                    dimensions=tuple(info['level_dimensions'][0]),
+                    level_count=info['level_count'], mpp=info['mpp'] or 0,
+                    size=st.st_size, mtime=st.st_mtime)
+        try:
+            osr = OpenSlide(path)
+        except OpenSlideError:
+            return None
+        try:
+            mpp_x = osr.properties[openslide.PROPERTY_NAME_MPP_X]
+            mpp_y = osr.properties[openslide.PROPERTY_NAME_MPP_Y]
+            mpp = (float(mpp_x) + float(mpp_y)) / 2
+        except (KeyError, ValueError):
+            mpp = 0
+        slide = _SlideFile(relpath, dimensions=osr.dimensions,
+                level_count=osr.level_count, mpp=mpp, size=st.st_size,
+                mtime=st.st_mtime)
+        osr.close()
         return slide
 
+    def get(self, relpath):
+        return self._slides.get(relpath)
+
 
 class _Directory(object):
-    def __init__(self, basedir, relpath=''):
-        self.name = os.path.basename(relpath)
-        self.children = []
-        for name in sorted(os.listdir(os.path.join(basedir, relpath))):
-            cur_relpath = os.path.join(relpath, name)
-            cur_path = os.path.join(basedir, cur_relpath)
-            if os.path.isdir(cur_path):
-                cur_dir = _Directory(basedir, cur_relpath)
-                if cur_dir.children:
-                    self.children.append(cur_dir)
-            elif OpenSlide.detect_format(cur_path):
-                self.children.append(_SlideFile(cur_relpath))
+    def __init__(self, name, children):
+        self.name = name
+        self.children = children
 
 
 class _SlideFile(object):
-    def __init__(self, relpath):
+    def __init__(self, relpath, dimensions=None, level_count=None, mpp=0,
+            size=None, mtime=None):
         self.name = os.path.basename(relpath)
         self.url_path = relpath
+        self.dimensions = dimensions
+        self.level_count = level_count
+        self.mpp = mpp
+        self.size = size
+        self.mtime = mtime
 
 
 @app.before_first_request
 def _setup():
+    if getattr(app, 'catalog', None) is not None:
+        # Already set up by another front end (deepzoom_async)
+        return
     app.basedir = os.path.abspath(app.config['SLIDE_DIR'])
     config_map = {
         'DEEPZOOM_TILE_SIZE': 'tile_size',
@@ -110,15 +296,67 @@ def _setup():
     }
     opts = dict((v, app.config[k]) for k, v in config_map.items())
     app.cache = _SlideCache(app.config['SLIDE_CACHE_SIZE'], opts)
+    app.tile_cache = _TileCache(app.config['TILE_CACHE_SIZE'] * 1024 * 1024,
+            app.config['TILE_CACHE_DIR'])
+    app.pyramid_checks = {}
+    app.catalog = _SlideCatalog(app.basedir, app.config['CATALOG_REFRESH'],
+            app.config['SLIDE_CATALOG'])
 
 
-def _get_slide(path):
+def _resolve_path(path):
     path = os.path.abspath(os.path.join(app.basedir, path))
     if not path.startswith(app.basedir + os.path.sep):
         # Directory traversal
-        abort(404)
+        return None
     if not os.path.exists(path):
+        return None
+    return path
+
+
+def _get_path(path):
+    path = _resolve_path(path)
+    if path is None:
         abort(404)
+    return path
+
+
+def _pyramid_matches(path, slide_path):
+    '''Whether the pyramid of a slide was rendered with the current Deep Zoom
+    settings, i.e. its stored .dzi is the one the server would generate.'''
+    dzi_path = os.path.join(app.config['PYRAMID_DIR'], path + '.dzi')
+    key = (path, os.path.getmtime(dzi_path), os.path.getmtime(slide_path))
+    if key not in app.pyramid_checks:
+        with open(dzi_path, 'r') as f:
+            stored_dzi = f.read()
+        try:
+            live_dzi = app.cache.get(slide_path).get_dzi(
+                    app.config['DEEPZOOM_FORMAT'])
+        except OpenSlideError:
+            return False
+        app.pyramid_checks[key] = stored_dzi == live_dzi
+    return app.pyramid_checks[key]
+
+
+def _read_pyramid_tile(path, slide_path, level, col, row, format):
+    '''Returns a tile pre-rendered by deepzoom_pyramid, unless missing, older
+    than the slide or rendered with other Deep Zoom settings.'''
+    if not app.config['PYRAMID_DIR']:
+        return None
+    tile_path = os.path.join(app.config['PYRAMID_DIR'], path + '_files',
+            str(level), '%d_%d.%s' % (col, row, format))
+    try:
+        if os.path.getmtime(tile_path) < os.path.getmtime(slide_path):
+            return None
+        if not _pyramid_matches(path, slide_path):
+            return None
+        with open(tile_path, 'rb') as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+
+def _get_slide(path):
+    path = _get_path(path)
     try:
         slide = app.cache.get(path)
         slide.filename = os.path.basename(path)
@@ -127,17 +365,46 @@ def _get_slide(path):
         abort(404)
 
 
+def _tile_key(slide_path, level, col, row, format):
+    # Tiles rendered with other Deep Zoom options may be left in the disk cache
+    return (slide_path, os.path.getmtime(slide_path), level, col, row, format,
+            app.config['DEEPZOOM_TILE_QUALITY'],
+            tuple(sorted(app.cache.dz_opts.items())))
+
+
+def _load_tile(path, slide_path, key):
+    '''Encoded tile from the tile cache, the pre-rendered pyramid or rendered
+    live. Raises ValueError for invalid levels or coordinates.'''
+    _, _, level, col, row, format, quality, _ = key
+    data = app.tile_cache.get(key)
+    if data is None:
+        data = _read_pyramid_tile(path, slide_path, level, col, row, format)
+    if data is None:
+        tile = app.cache.get(slide_path).get_tile(level, (col, row))
+        buf = PILBytesIO()
+        tile.save(buf, format, quality=quality)
+        data = buf.getvalue()
+        app.tile_cache.put(key, data)
+    return data
+
+
 @app.route('/')
 def index():
-    return render_template('files.html', root_dir=_Directory(app.basedir))
+    # Only the first request after startup waits for the catalog
+    app.catalog.ready.wait()
+    return render_template('files.html', root_dir=app.catalog.root)
 
 
 @app.route('/<path:path>')
 def slide(path):
-    slide = _get_slide(path)
+    slide_path = _get_path(path)
+    slide = app.catalog.get(os.path.relpath(slide_path, app.basedir))
+    if slide is None or slide.mtime != os.path.getmtime(slide_path):
+        slide = _get_slide(path)
+        slide.name = slide.filename
     slide_url = url_for('dzi', path=path)
     return render_template('slide-fullpage.html', slide_url=slide_url,
-            slide_filename=slide.filename, slide_mpp=slide.mpp)
+            slide_filename=slide.name, slide_mpp=slide.mpp)
 
 
 @app.route('/<path:path>.dzi')
@@ -151,23 +418,61 @@ def dzi(path):
 
 @app.route('/<path:path>_files/<int:level>/<int:col>_<int:row>.<format>')
 def tile(path, level, col, row, format):
-    slide = _get_slide(path)
     format = format.lower()
     if format != 'jpeg' and format != 'png':
         # Not supported by Deep Zoom
         abort(404)
-    try:
-        tile = slide.get_tile(level, (col, row))
-    except ValueError:
-        # Invalid level or coordinates
-        abort(404)
-    buf = PILBytesIO()
-    tile.save(buf, format, quality=app.config['DEEPZOOM_TILE_QUALITY'])
-    resp = make_response(buf.getvalue())
-    resp.mimetype = 'image/%s' % format
+    slide_path = _get_path(path)
+    key = _tile_key(slide_path, level, col, row, format)
+    etag = _TileCache.etag(key)
+    if etag in request.if_none_match:
+        resp = make_response('', 304)
+    else:
+        try:
+            data = _load_tile(path, slide_path, key)
+        except (ValueError, OpenSlideError):
+            # Invalid level or coordinates, or unreadable slide
+            abort(404)
+        resp = make_response(data)
+        resp.mimetype = 'image/%s' % format
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = app.config['TILE_CACHE_MAX_AGE']
     return resp
 
 
+def run_workers(host, port, workers):
+    '''Serves the app from several forked processes accepting on one shared
+    socket. Each process renders tiles with its own GIL and has its own slide
+    and tile caches.'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+
+    pids = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            server = make_server(host, port, app, threaded=True,
+                    fd=sock.fileno())
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        pids.append(pid)
+
+    def _stop(signum, frame):
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+    signal.signal(signal.SIGTERM, _stop)
+    try:
+        for pid in pids:
+            os.waitpid(pid, 0)
+    except KeyboardInterrupt:
+        _stop(None, None)
+
+
 if __name__ == '__main__':
     parser = OptionParser(usage='Usage: %prog [options] [slide-directory]')
     parser.add_option('-B', '--ignore-bounds', dest='DEEPZOOM_LIMIT_BOUNDS',
@@ -195,6 +500,18 @@ if __name__ == '__main__':
     parser.add_option('-s', '--size', metavar='PIXELS',
                 dest='DEEPZOOM_TILE_SIZE', type='int',
                 help='tile size [254]')
+    parser.add_option('-m', '--tile-cache-size', metavar='MB',
+                dest='TILE_CACHE_SIZE', type='int',
+                help='memory for cached tiles [256]')
+    parser.add_option('-t', '--tile-cache-dir', metavar='DIR',
+                dest='TILE_CACHE_DIR',
+                help='directory to also cache tiles on disk')
+    parser.add_option('-w', '--workers', metavar='COUNT', dest='workers',
+                type='int', default=1,
+                help='number of server processes [1]')
+    parser.add_option('-P', '--pyramid-dir', metavar='DIR',
+                dest='PYRAMID_DIR',
+                help='directory of tiles pre-rendered by deepzoom_pyramid')
 
     (opts, args) = parser.parse_args()
     # Load config file if specified
@@ -211,4 +528,7 @@ if __name__ == '__main__':
     except IndexError:
         pass
 
-    app.run(host=opts.host, port=opts.port, threaded=True)
+    if opts.workers > 1:
+        run_workers(opts.host, opts.port, opts.workers)
+    else:
+        app.run(host=opts.host, port=opts.port, threaded=True)
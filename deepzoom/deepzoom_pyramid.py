@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+#
+# deepzoom_pyramid - Pre-render the Deep Zoom pyramids of a directory of slides
+#
+# Uses the same DEEPZOOM_* settings as deepzoom_multiserver, so the server can
+# serve the pre-rendered tiles (PYRAMID_DIR) instead of rendering them live.
+#
+
+from multiprocessing import Pool
+from openslide import OpenSlide
+from openslide.deepzoom import DeepZoomGenerator
+import os
+from optparse import OptionParser
+
+from deepzoom_multiserver import PILBytesIO, app
+
+_slides = {}
+
+
+def _pyramid_opts():
+    config_map = {
+        'DEEPZOOM_TILE_SIZE': 'tile_size',
+        'DEEPZOOM_OVERLAP': 'overlap',
+        'DEEPZOOM_LIMIT_BOUNDS': 'limit_bounds',
+    }
+    return dict((v, app.config[k]) for k, v in config_map.items())
+
+
+def _get_generator(path, dz_opts):
+    # Each worker process only keeps the slide it is rendering open
+    if path not in _slides:
+        for osr, _ in _slides.values():
+            osr.close()
+        _slides.clear()
+        osr = OpenSlide(path)
+        _slides[path] = (osr, DeepZoomGenerator(osr, **dz_opts))
+    return _slides[path][1]
+
+
+def _write(path, data):
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _render_row(args):
+    '''Renders one row of tiles of a level, skipping tiles already rendered
+    after the slide was last modified. Returns the number of new tiles.'''
+    slide_path, tiles_dir, level, row, dz_opts, format, quality = args
+    dz = _get_generator(slide_path, dz_opts)
+    slide_mtime = os.path.getmtime(slide_path)
+    level_dir = os.path.join(tiles_dir, str(level))
+    if not os.path.isdir(level_dir):
+        os.makedirs(level_dir, exist_ok=True)
+
+    count = 0
+    for col in range(dz.level_tiles[level][0]):
+        tile_path = os.path.join(level_dir, '%d_%d.%s' % (col, row, format))
+        if (os.path.exists(tile_path) and
+                os.path.getmtime(tile_path) >= slide_mtime):
+            continue
+        buf = PILBytesIO()
+        dz.get_tile(level, (col, row)).save(buf, format, quality=quality)
+        _write(tile_path, buf.getvalue())
+        count += 1
+    return count
+
+
+def _find_slides(basedir, relpath=''):
+    slides = []
+    for name in sorted(os.listdir(os.path.join(basedir, relpath))):
+        cur_relpath = os.path.join(relpath, name)
+        cur_path = os.path.join(basedir, cur_relpath)
+        if os.path.isdir(cur_path):
+            slides.extend(_find_slides(basedir, cur_relpath))
+        elif OpenSlide.detect_format(cur_path):
+            slides.append(cur_relpath)
+    return slides
+
+
+def render_pyramids(slide_dir, pyramid_dir, workers=4):
+    '''Writes <relpath>.dzi and <relpath>_files/<level>/<col>_<row>.<format>
+    for every slide under slide_dir, mirroring the server URLs.'''
+    dz_opts = _pyramid_opts()
+    format = app.config['DEEPZOOM_FORMAT']
+    quality = app.config['DEEPZOOM_TILE_QUALITY']
+
+    tasks = []
+    for relpath in _find_slides(slide_dir):
+        slide_path = os.path.join(slide_dir, relpath)
+        out_path = os.path.join(pyramid_dir, relpath)
+        if not os.path.isdir(os.path.dirname(out_path)):
+            os.makedirs(os.path.dirname(out_path), exist_ok=True)
+
+        osr = OpenSlide(slide_path)
+        dz = DeepZoomGenerator(osr, **dz_opts)
+        _write(out_path + '.dzi', dz.get_dzi(format).encode('utf-8'))
+        # Larger levels first, they take longest
+        for level in reversed(range(dz.level_count)):
+            for row in range(dz.level_tiles[level][1]):
+                tasks.append((slide_path, out_path + '_files', level, row,
+                        dz_opts, format, quality))
+        osr.close()
+
+    pool = Pool(workers)
+    try:
+        return sum(pool.imap_unordered(_render_row, tasks))
+    finally:
+        pool.close()
+        pool.join()
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='Usage: %prog [options] slide-directory')
+    parser.add_option('-B', '--ignore-bounds', dest='DEEPZOOM_LIMIT_BOUNDS',
+                default=True, action='store_false',
+                help='display entire scan area')
+    parser.add_option('-c', '--config', metavar='FILE', dest='config',
+                help='config file')
+    parser.add_option('-e', '--overlap', metavar='PIXELS',
+                dest='DEEPZOOM_OVERLAP', type='int',
+                help='overlap of adjacent tiles [1]')
+    parser.add_option('-f', '--format', metavar='{jpeg|png}',
+                dest='DEEPZOOM_FORMAT',
+                help='image format for tiles [jpeg]')
+    parser.add_option('-o', '--output', metavar='DIR', dest='PYRAMID_DIR',
+                help='output directory [PYRAMID_DIR]')
+    parser.add_option('-j', '--jobs', metavar='COUNT', dest='workers',
+                type='int', default=4,
+                help='number of worker processes [4]')
+    parser.add_option('-Q', '--quality', metavar='QUALITY',
+                dest='DEEPZOOM_TILE_QUALITY', type='int',
+                help='JPEG compression quality [75]')
+    parser.add_option('-s', '--size', metavar='PIXELS',
+                dest='DEEPZOOM_TILE_SIZE', type='int',
+                help='tile size [254]')
+
+    (opts, args) = parser.parse_args()
+    # Load config file if specified
+    if opts.config is not None:
+        app.config.from_pyfile(opts.config)
+    # Overwrite only those settings specified on the command line
+    for k in dir(opts):
+        if not k.startswith('_') and getattr(opts, k) is None:
+            delattr(opts, k)
+    app.config.from_object(opts)
+    try:
+        slide_dir = args[0]
+    except IndexError:
+        parser.error('Missing slide directory argument')
+    if not app.config['PYRAMID_DIR']:
+        parser.error('Missing output directory (-o or PYRAMID_DIR)')
+
+    count = render_pyramids(slide_dir, app.config['PYRAMID_DIR'], opts.workers)
+    print('Rendered %d tiles' % count)
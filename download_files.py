@@ -1,11 +1,12 @@
 import argparse
 import os
-import re
 import yaml
 import pandas as pd
+from datetime import timedelta
 
-from gdc.download import api_download_iterative
-from gdc.utils import gunzip
+from gdc.download import api_download_pooled
+from gdc.schedule import plan_downloads
+from gdc.manifest import DownloadManifest
 
 def print_summary(df, gb_field):
 
@@ -38,23 +39,25 @@ def main(args):
         slides_df = slides_df[slides_df['sample_id'].isin(rnaseq_df['sample_id'])]
         rnaseq_df = rnaseq_df[rnaseq_df['sample_id'].isin(slides_df['sample_id'])]
     
-    print('Downloading slides...')
+    print('Slides:')
     print_summary(slides_df, 'experimental_strategy')
 
-    api_download_iterative(slides_df, slides_path, multiprocess=args.multiprocess)
-    print('OK')
-    
-    print('Downloading rnaseq...')
+    print('RNA-seq:')
     print_summary(rnaseq_df, 'workflow_type')
 
-    api_download_iterative(rnaseq_df, rnaseq_path, multiprocess=args.multiprocess)
-    files = api_download_iterative(rnaseq_df, rnaseq_path, multiprocess=8)
+    manifest = DownloadManifest(conf['data_path'])
+
+    # RNA-seq files are gunzipped on the fly
+    rnaseq_df = rnaseq_df.assign(decompress=True)
+
+    jobs, makespan = plan_downloads({slides_path: slides_df, rnaseq_path: rnaseq_df}, args.multiprocess, 
+                                    download_manifest=manifest)
+    print('Downloading {} files, expected time: {}'.format(len(jobs), timedelta(seconds=int(makespan))))
+
+    api_download_pooled(jobs, None, n_workers=args.multiprocess, n_connections=args.connections, 
+                        manifest=manifest)
 
-    for file_name in files:
-        zipped_file = os.path.join(rnaseq_path, file_name)
-        unzipped_file = re.sub('\.gz$', '', zipped_file)
-        gunzip(zipped_file, unzipped_file)
-        os.remove(zipped_file)
+    manifest.close()
 
     print('OK')
 
@@ -65,7 +68,9 @@ if __name__ == "__main__":
     parser.add_argument('-conf', help="Path to config file", type=str, default='conf/user_conf.yaml')
     parser.add_argument('-in_both', help="Whether to download only files from samples with both slides and rnaseq", 
                         default=True)
-    parser.add_argument('-multiprocess', help='Number of processes to run in parallel', default=4)
+    parser.add_argument('-multiprocess', help='Number of files to download in parallel', type=int, default=4)
+    parser.add_argument('-connections', help='Number of parallel range connections per slide (resumable)', 
+                        type=int, default=1)
 
     args = parser.parse_args()
 
@@ -5,25 +5,35 @@ import argparse
 from gdc.metadata import get_rnaseq_metadata
 from gdc.metadata import get_slides_metadata
 from gdc.metadata import get_cases
+from gdc.cache import ResponseCache
 
 def main(args):
 
     with open(args.conf, 'r') as f:
         conf = yaml.load(f)
 
-    cases_df = get_cases(conf['cases_info'], conf['fields']['cases'])
+    cache = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir if args.cache_dir else os.path.join(conf['data_path'], 'cache')
+        cache = ResponseCache(cache_dir, ttl=args.cache_ttl * 3600)
+
+    cases_df = get_cases(conf['cases_info'], conf['fields']['cases'], cache=cache)
     cases_df.to_csv(os.path.join(conf['data_path'], 'cases.csv'), sep='|', index=False)
 
-    slides_df = get_slides_metadata(conf['cases_info'], conf['fields']['slides'])
+    slides_df = get_slides_metadata(conf['cases_info'], conf['fields']['slides'], cache=cache)
     slides_df.to_csv(os.path.join(conf['data_path'], 'slides_metadata.csv'), sep='|', index=False)
 
-    rnaseq_df = get_rnaseq_metadata(conf['cases_info'], conf['fields']['rnaseq'])
+    rnaseq_df = get_rnaseq_metadata(conf['cases_info'], conf['fields']['rnaseq'], cache=cache)
     rnaseq_df.to_csv(os.path.join(conf['data_path'], 'rnaseq_metadata.csv'), sep='|', index=False)
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser("Download Files")
     parser.add_argument('-conf', help="Path to config file", type=str, default='conf/user_conf.yaml')
+    parser.add_argument('-cache_dir', help="Directory of the API response cache (default: data_path/cache)", 
+                        type=str, default=None)
+    parser.add_argument('-cache_ttl', help="Hours before a cached response expires", type=float, default=24)
+    parser.add_argument('-no_cache', help="Always query the GDC API", action='store_true')
 
     args = parser.parse_args()
 
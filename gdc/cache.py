@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from urllib.parse import urlparse
+
+CACHE_EXT = '.cache'
+
+
+class ResponseCache(object):
+    """
+    Content addressed on-disk cache of GDC API responses. Entries are keyed by the endpoint 
+    path and the canonical JSON of the request parameters, expire after ttl seconds (never 
+    if None) and the least recently used ones are evicted above max_size MB.
+    """
+
+    def __init__(self, path, ttl=7*24*3600, max_size=500):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+
+        if not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+    @staticmethod
+    def key(endpoint, params):
+
+        canonical = json.dumps(params, sort_keys=True, separators=(',', ':'))
+        key = urlparse(endpoint).path + '?' + canonical
+
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    def _file_path(self, endpoint, params):
+        return os.path.join(self.path, self.key(endpoint, params) + CACHE_EXT)
+
+    def get(self, endpoint, params):
+
+        file_path = self._file_path(endpoint, params)
+
+        # The entry can be evicted by another thread at any point
+        try:
+            mtime = os.path.getmtime(file_path)
+
+            if (self.ttl is not None) and (time.time() - mtime > self.ttl):
+                self._remove(file_path)
+                return None
+
+            with open(file_path, 'rb') as f:
+                content = f.read()
+
+            # Access time is used for the LRU eviction
+            os.utime(file_path, (time.time(), mtime))
+
+        except FileNotFoundError:
+            return None
+
+        return content
+
+    def set(self, endpoint, params, content):
+
+        file_path = self._file_path(endpoint, params)
+        tmp_path = file_path + '.{}.{}.tmp'.format(os.getpid(), threading.get_ident())
+
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        os.replace(tmp_path, file_path)
+
+        self.evict()
+
+    @staticmethod
+    def _remove(file_path):
+        # Already removed (expired in get or evicted) is fine
+        try:
+            os.remove(file_path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+
+        with self._lock:
+            entries = []
+            for file_name in os.listdir(self.path):
+                if file_name.endswith(CACHE_EXT):
+                    try:
+                        stat = os.stat(os.path.join(self.path, file_name))
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_atime, stat.st_size, file_name))
+
+            total_size = sum(x[1] for x in entries)
+
+            for _, size, file_name in sorted(entries):
+                if total_size <= self.max_size * 10**6:
+                    break
+                self._remove(os.path.join(self.path, file_name))
+                total_size -= size
+
+    def clear(self):
+
+        with self._lock:
+            for file_name in os.listdir(self.path):
+                if file_name.endswith(CACHE_EXT):
+                    self._remove(os.path.join(self.path, file_name))
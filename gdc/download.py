@@ -1,12 +1,21 @@
 import os
+import io
 import re
+import zlib
+import gzip
+import shutil
 import json
+import hashlib
 import subprocess
 import requests
 import tarfile
 from functools import partial
 from multiprocessing import Pool
+from threading import Lock, Condition
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
+from gdc.utils import md5_file
+from gdc.manifest import STORED
 try:
     get_ipython()
     from tqdm import tqdm_notebook as tqdm
@@ -14,6 +23,8 @@ except:
     from tqdm import tqdm
 
 DATA_ENDPOINT = 'https://api.gdc.cancer.gov/data/'
+CHECKPOINT_EXT = '.parts'
+TMP_EXT = '.tmp'
 
 
 def gdc_tool_download(files, out_dir, gdc_tool):
@@ -36,14 +47,41 @@ def gdc_tool_download(files, out_dir, gdc_tool):
         print(e.output.decode('utf-8'))
 
 
+def _check_md5(file_name, md5, md5sum, tmp_path=None):
+
+    if isinstance(md5sum, str) and (md5 != md5sum):
+        if tmp_path is not None:
+            os.remove(tmp_path)
+        raise IOError('Checksum mismatch for {}'.format(file_name))
+
+
 def _save_response(response, output_dir, stream=True, file_size=None, chunk_size=1, 
-                   file_name=None):
+                   file_name=None, md5sum=None, decompress=False, counts_store=None):
+    """
+    Writes the response to a temporary file, checks it against md5sum (if given) and 
+    renames it to its final path. If decompress, the gzip stream is decompressed on the fly 
+    and saved without the .gz extension. If a counts_store is given (RNA-seq), the 
+    decompressed data is added to it instead of being written to disk.
+    """
     
     response_head_cd = response.headers["Content-Disposition"]
     file_name = file_name if file_name != None else re.findall("filename=(.+)", response_head_cd)[0]
+    progress_desc = file_name
+
+    decompress = decompress or (counts_store is not None)
+    if decompress:
+        file_name = re.sub('\.gz$', '', file_name)
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
     file_path = os.path.join(output_dir, file_name)
+    tmp_path = file_path + TMP_EXT if counts_store is None else None
     
-    output_file = open(file_path, "wb")
+    output_file = open(tmp_path, "wb") if counts_store is None else io.BytesIO()
+    md5 = hashlib.md5()
+
+    def write(chunk):
+        md5.update(chunk)
+        output_file.write(decompressor.decompress(chunk) if decompress else chunk)
         
     if stream:        
 
@@ -51,11 +89,11 @@ def _save_response(response, output_dir, stream=True, file_size=None, chunk_size
         print(' ', end='\r', flush=True)
 
         n_chunks = int(round(file_size*1024/chunk_size, 0))                
-        progress_bar =  tqdm(leave=False, total=n_chunks, desc=file_name, 
+        progress_bar =  tqdm(leave=False, total=n_chunks, desc=progress_desc, 
                             unit='⋅{}kb'.format(chunk_size), unit_scale=True)
 
         for chunk in response.iter_content(chunk_size= int(chunk_size*1024)):
-            output_file.write(chunk)
+            write(chunk)
             progress_bar.update(1)
         
         if progress_bar.n < n_chunks:
@@ -63,32 +101,323 @@ def _save_response(response, output_dir, stream=True, file_size=None, chunk_size
         progress_bar.close()
 
     else:
-        output_file.write(response.content)
+        write(response.content)
 
-    output_file.close()
+    if decompress:
+        output_file.write(decompressor.flush())
+
+    if counts_store is None:
+        output_file.close()
+        _check_md5(file_name, md5.hexdigest(), md5sum, tmp_path)
+        os.replace(tmp_path, file_path)
+    else:
+        _check_md5(file_name, md5.hexdigest(), md5sum)
+        counts_store.add(file_name, output_file.getvalue())
     
     return file_name
     
     
-def api_download_single(file, output_dir, stream=True, chunk_size=1, progress_bar=True):
+class _ByteBudget(object):
+    """
+    Caps the total size (MB) of the files being downloaded at the same time. A file bigger 
+    than the budget is still allowed when nothing else is in flight.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.inflight = 0
+        self._condition = Condition()
+
+    def acquire(self, size):
+        with self._condition:
+            while (self.inflight > 0) & (self.inflight + size > self.max_size):
+                self._condition.wait()
+            self.inflight += size
+
+    def release(self, size):
+        with self._condition:
+            self.inflight -= size
+            self._condition.notify_all()
+
+
+def _create_session(pool_size):
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+
+    return session
+
+
+class _Checkpoint(object):
+    """
+    Sidecar file recording how many bytes of each range segment are already on disk.
+    """
+
+    def __init__(self, path, file_size, segment_size):
+        self.path = path
+        self.file_size = file_size
+        self.segment_size = segment_size
+        self._lock = Lock()
+        self.offsets = {}
+
+        try:
+            with open(self.path, 'r') as f:
+                checkpoint = json.load(f)
+            if (checkpoint['file_size'] == file_size) & (checkpoint['segment_size'] == segment_size):
+                self.offsets = {int(k): v for k, v in checkpoint['offsets'].items()}
+        except (IOError, ValueError, KeyError, AttributeError):
+            # Missing or unreadable sidecar: start from scratch
+            self.offsets = {}
+
+    def update(self, segment, offset):
+        with self._lock:
+            self.offsets[segment] = offset
+            # Written to a temporary file and renamed, so a kill never leaves it truncated
+            tmp_path = self.path + TMP_EXT
+            with open(tmp_path, 'w') as f:
+                json.dump({'file_size': self.file_size, 
+                           'segment_size': self.segment_size, 
+                           'offsets': self.offsets}, f)
+            os.replace(tmp_path, self.path)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def _get_segments(file_size, segment_size):
+
+    segments = []
+    for start in range(0, file_size, segment_size):
+        end = min(start + segment_size, file_size) - 1
+        segments.append((start, end))
+
+    return segments
+
+
+def _probe_ranges(session, url):
+    """
+    Requests the first byte of a file to get its exact size and name, and to check whether 
+    the server accepts HTTP Range requests.
+    """
+
+    response = session.get(url, headers={'Range': 'bytes=0-0'}, stream=True)
+    response.raise_for_status()
+
+    response_head_cd = response.headers.get('Content-Disposition', '')
+    file_name = re.findall("filename=(.+)", response_head_cd)
+    file_name = file_name[0] if file_name else None
+
+    content_range = response.headers.get('Content-Range')
+    response.close()
+
+    if (response.status_code != 206) | (content_range is None):
+        return None, file_name
+
+    return int(content_range.rsplit('/', 1)[-1]), file_name
+
+
+def _download_segment(session, url, file_path, segment, start, end, checkpoint, progress_bar, 
+                      chunk_size=1024, max_retries=3):
+
+    offset = checkpoint.offsets.get(segment, 0)
+    retries = 0
+
+    while start + offset <= end:
+
+        if retries > max_retries:
+            raise IOError('Segment {} of {} failed after {} retries'.format(segment, file_path, max_retries))
+
+        try:
+            headers = {'Range': 'bytes={}-{}'.format(start + offset, end)}
+            response = session.get(url, headers=headers, stream=True)
+            response.raise_for_status()
+
+            if response.status_code != 206:
+                raise IOError('Server ignored the range request for {}'.format(file_path))
+
+            with open(file_path, 'r+b') as output_file:
+                output_file.seek(start + offset)
+                for chunk in response.iter_content(chunk_size=int(chunk_size*1024)):
+                    output_file.write(chunk)
+                    output_file.flush()
+                    offset += len(chunk)
+                    checkpoint.update(segment, offset)
+                    progress_bar.update(len(chunk))
+
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError):
+            pass
+
+        # Connection dropped before the end of the segment
+        if start + offset <= end:
+            retries += 1
+
+    return offset
+
+
+def api_download_ranged(file, output_dir, n_connections=4, segment_size=64, chunk_size=1024, 
+                        max_retries=3):
+    """
+    Downloads a single file splitting it in HTTP Range segments (of segment_size MB) fetched 
+    in parallel over n_connections into a preallocated file. Progress is checkpointed to a 
+    sidecar file so an interrupted download resumes at the first missing byte of each segment.
+    """
+
+    query = DATA_ENDPOINT + file['file_id']
+
+    session = _create_session(n_connections)
+
+    file_size, file_name = _probe_ranges(session, query)
+    file_name = file['file_name'] if 'file_name' in file else file_name
+
+    if file_size is None:
+        # Server does not support ranges, fallback to a single stream
+        session.close()
+        return api_download_single(file, output_dir, stream=True)
+
+    file_path = os.path.join(output_dir, file_name)
+    tmp_path = file_path + TMP_EXT
+    checkpoint = _Checkpoint(tmp_path + CHECKPOINT_EXT, file_size, int(segment_size*1024**2))
+
+    # Preallocate. Offsets of a stale sidecar do not apply to a new zero-filled file
+    if (not os.path.exists(tmp_path)) | (len(checkpoint.offsets) == 0):
+        with open(tmp_path, 'wb') as output_file:
+            output_file.truncate(file_size)
+        checkpoint.offsets = {}
+
+    segments = _get_segments(file_size, checkpoint.segment_size)
+
+    progress_bar = tqdm(leave=False, total=file_size, desc=file_name, unit='B', unit_scale=True, 
+                        initial=sum(checkpoint.offsets.values()))
+
+    func = partial(_download_segment, session, query, tmp_path, checkpoint=checkpoint, 
+                   progress_bar=progress_bar, chunk_size=chunk_size, max_retries=max_retries)
+
+    with ThreadPoolExecutor(max_workers=n_connections) as executor:
+        futures = [executor.submit(func, i, start, end) for i, (start, end) in enumerate(segments)]
+        for future in futures:
+            future.result()
+
+    progress_bar.close()
+    session.close()
+
+    _check_md5(file_name, md5_file(tmp_path), file.get('md5sum'), tmp_path)
+    checkpoint.remove()
+    os.replace(tmp_path, file_path)
+
+    return file_name
+
+
+def api_download_single(file, output_dir, stream=True, chunk_size=1, progress_bar=True, 
+                        n_connections=1, session=None, decompress=False, counts_store=None):
+
+    if (n_connections > 1) and (not decompress) and (counts_store is None):
+        return api_download_ranged(file, output_dir, n_connections=n_connections)
     
     query = DATA_ENDPOINT + file['file_id']
+    session = session if session != None else requests
         
-    response = requests.get(query, 
+    response = session.get(query, 
                             headers = {"Content-Type": "application/json"}, 
                             stream=stream)
     
     file_name = file['file_name'] if 'file_name' in file else None
-    file_name = _save_response(response, output_dir, stream, file['file_size'], chunk_size, file_name)
+    file_name = _save_response(response, output_dir, stream, file['file_size'], chunk_size, file_name, 
+                               file.get('md5sum'), decompress, counts_store)
     
     return file_name
 
 
 
-def api_download_iterative(files, output_dir, stream=True, chunk_size=1, multiprocess=False):
+def _pooled_download(file, output_dir, session, budget, stream=True, chunk_size=1, n_connections=1, 
+                     ranged_min_size=100, manifest=None, decompress=False, counts_store=None, stored=None):
+
+    output_dir = file.get('output_dir', output_dir)
+    decompress = file.get('decompress', decompress)
+    n_connections = n_connections if file['file_size'] >= ranged_min_size else 1
+
+    budget.acquire(file['file_size'])
+    try:
+        file_name = api_download_single(file, output_dir, stream=stream, chunk_size=chunk_size, 
+                                        n_connections=n_connections, session=session, 
+                                        decompress=decompress, counts_store=counts_store)
+    except Exception as e:
+        if manifest is None:
+            raise e
+        print('Error downloading {}: {}'.format(file['file_id'], e))
+        manifest.add_file(file, None, status='failed')
+        return None
+    finally:
+        budget.release(file['file_size'])
+
+    if counts_store is not None:
+        # Recorded by its column in the store once the store is saved
+        stored.append(dict(file, file_name=file_name))
+    elif manifest is not None:
+        manifest.add_file(file, os.path.join(output_dir, file_name))
+
+    return file_name
+
+
+def api_download_pooled(files, output_dir, n_workers=4, max_inflight=4000, stream=True, chunk_size=1, 
+                        n_connections=1, ranged_min_size=100, manifest=None, decompress=False, 
+                        counts_store=None):
+    """
+    Downloads a list of files with a pool of threads sharing a single pool of keep-alive 
+    connections. max_inflight caps the total size (MB) of the files downloading at once, 
+    so thousands of small files can be queued together with a few huge slides. Files are 
+    started in the given order and an 'output_dir' field in a file overrides output_dir. 
+    Files of at least ranged_min_size MB use n_connections range connections. With a 
+    DownloadManifest, files already complete are skipped and each result is recorded. 
+    decompress (or a 'decompress' field per file) gunzips the files on the fly. With a 
+    counts_store, the store is saved at the end (also if interrupted) and only then are 
+    its files recorded in the manifest.
+    """
+
+    if isinstance(files, pd.DataFrame):
+        files = files.to_dict(orient='records')
+
+    if manifest is not None:
+        files = manifest.pending(files, output_dir, counts_store=counts_store)
+
+    session = _create_session(n_workers)
+    budget = _ByteBudget(max_inflight)
+
+    stored = []
+
+    func = partial(_pooled_download, output_dir=output_dir, session=session, budget=budget, 
+                   stream=stream, chunk_size=chunk_size, n_connections=n_connections, 
+                   ranged_min_size=ranged_min_size, manifest=manifest, decompress=decompress, 
+                   counts_store=counts_store, stored=stored)
+
+    results = []
+
+    try:
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(func, file) for file in files]
+            for future in tqdm(as_completed(futures), total=len(futures), desc='Files', unit='file', 
+                               unit_scale=True):
+                results.append(future.result())
+    finally:
+        session.close()
+
+        if stored:
+            # A file only counts as stored once the store is on disk
+            counts_store.save()
+            if manifest is not None:
+                for file in stored:
+                    manifest.add_file(file, counts_store.path, status=STORED)
+
+    return results
+
+
+def api_download_iterative(files, output_dir, stream=True, chunk_size=1, multiprocess=False, 
+                           n_connections=1, backend='threads', max_inflight=4000):
     
     if isinstance(files, pd.DataFrame):
-        files = files.to_dict(orient='rows')
+        files = files.to_dict(orient='records')
     
     progress_bar = partial(tqdm, desc='Files', unit='file', unit_scale=True)
     
@@ -96,10 +425,16 @@ def api_download_iterative(files, output_dir, stream=True, chunk_size=1, multipr
     
     if not multiprocess:
         for file in progress_bar(files):
-            res = api_download_single(file, output_dir, stream=stream, chunk_size=chunk_size)
+            res = api_download_single(file, output_dir, stream=stream, chunk_size=chunk_size, 
+                                      n_connections=n_connections)
             results.append(res)
+    elif backend == 'threads':
+        results = api_download_pooled(files, output_dir, n_workers=int(multiprocess), 
+                                      max_inflight=max_inflight, stream=stream, chunk_size=chunk_size, 
+                                      n_connections=n_connections)
     else: 
-        func = partial(api_download_single, output_dir=output_dir, stream=stream, chunk_size=chunk_size)
+        func = partial(api_download_single, output_dir=output_dir, stream=stream, chunk_size=chunk_size, 
+                       n_connections=n_connections)
         with Pool(processes=multiprocess) as pool:
             for res in progress_bar(pool.imap_unordered(func, files), total=len(files)):
                 results.append(res)
@@ -107,7 +442,22 @@ def api_download_iterative(files, output_dir, stream=True, chunk_size=1, multipr
     return results
         
         
-def api_download_batch(files, output_dir, stream=True, chunk_size=1):
+def _safe_member_path(output_dir, member_name):
+
+    member_path = os.path.normpath(os.path.join(output_dir, member_name))
+    if not member_path.startswith(os.path.abspath(output_dir) + os.path.sep):
+        raise IOError('Unsafe path in archive: {}'.format(member_name))
+
+    return member_path
+
+
+def api_download_batch(files, output_dir, stream=True, chunk_size=1, decompress=False):
+    """
+    Downloads several files in a single request to the batch endpoint. The returned tarball 
+    is read as a stream ('r|*') and each member is written to its final location 
+    (<file_id>/<file_name>) as it arrives, decompressing .gz members inline if decompress. 
+    Returns the list of extracted files.
+    """
     
     if isinstance(files, pd.DataFrame):
         file_ids = files['file_id'].tolist()
@@ -122,16 +472,37 @@ def api_download_batch(files, output_dir, stream=True, chunk_size=1):
     response = requests.post(DATA_ENDPOINT, 
                              data = json.dumps(params), 
                              headers = {"Content-Type": "application/json"}, 
-                             stream=stream)
-    
-    file_name = _save_response(response, output_dir, stream, estimated_compressed_size, chunk_size)
-    
-    # Untar
-    tf = tarfile.open(os.path.join(output_dir, file_name))
-    tf.extractall(path=output_dir)
-    
-    # Remove files
-    os.remove(os.path.join(output_dir, file_name))
-    os.remove(os.path.join(output_dir, 'MANIFEST.TXT'))
+                             stream=True)
+    response.raise_for_status()
+    response.raw.decode_content = True
+
+    output_dir = os.path.abspath(output_dir)
+    extracted_files = []
+
+    progress_bar = tqdm.wrapattr(response.raw, 'read', total=int(estimated_compressed_size*10**6), 
+                                 desc='Batch', unit='B', unit_scale=True, leave=False)
+
+    with progress_bar as fileobj:
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tf:
+            for member in tf:
+                
+                if (not member.isfile()) or (os.path.basename(member.name) == 'MANIFEST.TXT'):
+                    continue
+
+                member_name = member.name
+                member_file = tf.extractfile(member)
+
+                if decompress and member_name.endswith('.gz'):
+                    member_name = re.sub('\.gz$', '', member_name)
+                    member_file = gzip.GzipFile(fileobj=member_file)
+
+                member_path = _safe_member_path(output_dir, member_name)
+                os.makedirs(os.path.dirname(member_path), exist_ok=True)
+                
+                with open(member_path + TMP_EXT, 'wb') as output_file:
+                    shutil.copyfileobj(member_file, output_file, int(chunk_size*1024))
+                os.replace(member_path + TMP_EXT, member_path)
+                
+                extracted_files.append(member_name)
     
-    return response
\ No newline at end of file
+    return extracted_files
@@ -0,0 +1,116 @@
+import os
+import sqlite3
+from threading import Lock
+import pandas as pd
+from gdc.utils import md5_file
+
+MANIFEST_FILE = 'download_manifest.db'
+STORED = 'stored'
+COLUMNS = ['file_id', 'file_name', 'file_path', 'file_size', 'md5sum', 'local_size', 'status']
+
+
+class DownloadManifest(object):
+    """
+    Persistent SQLite record of the downloaded files (one row per file_id) with their 
+    GDC size and md5sum, their path and size on disk and their download status. Files 
+    added to a CountsStore have status 'stored', the store path and their column name.
+    """
+
+    def __init__(self, path):
+
+        if os.path.isdir(path):
+            path = os.path.join(path, MANIFEST_FILE)
+
+        self.path = path
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                           'file_id TEXT PRIMARY KEY, file_name TEXT, file_path TEXT, file_size REAL, '
+                           'md5sum TEXT, local_size INTEGER, status TEXT)')
+        self._conn.commit()
+
+    def get(self, file_id):
+
+        with self._lock:
+            row = self._conn.execute('SELECT {} FROM downloads WHERE file_id = ?'.format(','.join(COLUMNS)), 
+                                     (file_id,)).fetchone()
+
+        return dict(zip(COLUMNS, row)) if row else None
+
+    def update(self, file_id, **values):
+
+        record = self.get(file_id) or {k: None for k in COLUMNS}
+        record.update(values)
+        record['file_id'] = file_id
+
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO downloads ({}) VALUES ({})'.format(
+                               ','.join(COLUMNS), ','.join('?' * len(COLUMNS))), 
+                               [record[k] for k in COLUMNS])
+            self._conn.commit()
+
+    def add_file(self, file, file_path, status='ok'):
+
+        # The size of a store changes as files are added, so it is not recorded
+        on_disk = (file_path is not None) and (status != STORED) and os.path.exists(file_path)
+        local_size = os.path.getsize(file_path) if on_disk else None
+        md5sum = file.get('md5sum')
+
+        self.update(file['file_id'], file_name=file.get('file_name'), file_path=file_path, 
+                    file_size=file.get('file_size'), md5sum=md5sum if isinstance(md5sum, str) else None, 
+                    local_size=local_size, status=status)
+
+    def relocate(self, file_id, file_path):
+        self.update(file_id, file_path=file_path, local_size=os.path.getsize(file_path))
+
+    def is_complete(self, file_id, counts_store=None):
+
+        record = self.get(file_id)
+
+        if (record is None) or (record['status'] not in ('ok', STORED)) or \
+           (not os.path.exists(record['file_path'])):
+            return False
+
+        if record['status'] == STORED:
+            # Only recorded once the store was saved with the file. A store loaded from 
+            # disk only has the files saved into it before
+            return (counts_store is None) or (record['file_name'] in counts_store)
+
+        return os.path.getsize(record['file_path']) == record['local_size']
+
+    def pending(self, files, output_dir=None, verify=True, counts_store=None):
+        """
+        Returns the files that still have to be downloaded. Files without a record that are 
+        already on disk are added as complete when their md5sum matches (if verify). Stored 
+        files are checked against counts_store if given.
+        """
+
+        if isinstance(files, pd.DataFrame):
+            files = files.to_dict(orient='records')
+
+        pending_files = []
+
+        for file in files:
+
+            if self.is_complete(file['file_id'], counts_store):
+                continue
+
+            file_path = os.path.join(file.get('output_dir', output_dir), file['file_name'])
+            md5sum = file.get('md5sum')
+
+            if (verify and isinstance(md5sum, str) and os.path.exists(file_path) and 
+                (self.get(file['file_id']) is None) and (md5_file(file_path) == md5sum)):
+                self.add_file(file, file_path)
+                continue
+
+            pending_files.append(file)
+
+        return pending_files
+
+    def to_dataframe(self):
+
+        with self._lock:
+            return pd.read_sql_query('SELECT * FROM downloads', self._conn)
+
+    def close(self):
+        self._conn.close()
@@ -1,13 +1,24 @@
+import os
 import requests
 import io
 import json
 import pandas as pd
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from gdc.filters import build_filter
-from gdc.utils import find_elem_by_submitter_id
 
 
-CASES_ENDPOINT = 'https://api.gdc.cancer.gov/cases'
-FILES_ENDPOINT = 'https://api.gdc.cancer.gov/files'
+# Can point to a local stand-in server (gdc.standin) to run offline
+GDC_API = os.environ.get('GDC_API', 'https://api.gdc.cancer.gov')
+
+CASES_ENDPOINT = GDC_API + '/cases'
+FILES_ENDPOINT = GDC_API + '/files'
+
+PAGE_SIZE = 1000
+N_WORKERS = 4
+
+SORT_FIELDS = {CASES_ENDPOINT: 'case_id:asc', 
+               FILES_ENDPOINT: 'file_id:asc'}
 
 SOURCE_PREFIXES = {'files': '',
                    'samples': 'cases.samples.',
@@ -20,59 +31,148 @@ def _multiple_column_check(df):
         print('WARNING! Multiple instances found in fields: ', multiple_check)
 
 
-def _find_slide(portions, slide_id):
+def _post(session, endpoint, params, cache=None):
+
+    if cache is not None:
+        content = cache.get(endpoint, params)
+        if content is not None:
+            return content
+
+    response = session.post(endpoint, headers={'Content-Type': 'application/json'}, json=params)
+    response.raise_for_status()
+
+    if cache is not None:
+        cache.set(endpoint, params, response.content)
+
+    return response.content
+
+
+def _count_hits(session, endpoint, query_filter, cache=None):
+
+    params = {'filters': query_filter, 'format': 'JSON', 'size': 0}
+    content = _post(session, endpoint, params, cache)
+
+    return json.loads(content)['data']['pagination']['total']
+
+
+def _post_page(session, endpoint, params, start, size, cache=None):
+
+    params = {**params, 'from': start, 'size': size, 'sort': SORT_FIELDS[endpoint]}
+
+    return _post(session, endpoint, params, cache)
+
+
+def _fetch_pages(endpoint, params, parse_page, max_results=None, page_size=PAGE_SIZE, n_workers=N_WORKERS, 
+                 cache=None):
+    """
+    Runs a query page by page (GDC from/size parameters) with n_workers concurrent requests. 
+    Each page is parsed with parse_page as soon as it arrives and the parsed pages are 
+    returned in order. Responses are read from / saved to cache (a ResponseCache) if given.
+    """
+
+    session = requests.Session()
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=n_workers))
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=n_workers))
+
+    total = _count_hits(session, endpoint, params['filters'], cache)
+    total = min(total, max_results) if max_results else total
+
+    starts = list(range(0, total, page_size))
+    pages = [None] * len(starts)
+
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        futures = {executor.submit(_post_page, session, endpoint, params, start, 
+                                   min(page_size, total - start), cache): i 
+                   for i, start in enumerate(starts)}
+        for future in as_completed(futures):
+            pages[futures[future]] = parse_page(future.result())
+
+    session.close()
+
+    return pages
+
+
+def _parse_tsv_page(content):
+    return pd.read_csv(io.StringIO(content.decode('utf-8')), sep='\t')
+
 
-    for portion in portions:
-        for slide in portion['slides']:
-            if slide_id == slide['submitter_id']:
-                slide_json = slide
-                break
-        else:
-            # Continue if the inner loop wasn't broken.
+def _fetch_tsv(endpoint, params, max_results=None, page_size=PAGE_SIZE, n_workers=N_WORKERS, cache=None):
+
+    pages = _fetch_pages(endpoint, params, _parse_tsv_page, max_results, page_size, n_workers, cache)
+
+    return pd.concat(pages, ignore_index=True, sort=False) if pages else pd.DataFrame()
+
+
+def _find_slide_path(hit, slide_id):
+    """
+    Case, sample and slide of a files hit whose submitter ids match its slide barcode, or
+    None. Slide barcodes start with their case and sample barcodes, so only the matching
+    branches are scanned, stopping at the first match.
+    """
+
+    for case in hit['cases']:
+        if slide_id.startswith(case['submitter_id']):
+            for sample in case['samples']:
+                if slide_id.startswith(sample['submitter_id']):
+                    for portion in sample['portions']:
+                        for slide in portion.get('slides', []):
+                            if slide['submitter_id'] == slide_id:
+                                return case, sample, slide
+
+    return None
+
+
+def _flatten_slides_json(hits, fields):
+    """
+    Finds the case, sample and slide of each files hit and builds the output column by
+    column instead of one dict per hit. Hits with no slide matching their barcode are
+    dropped with a warning.
+    """
+
+    files, cases, samples, slides, slide_ids, dropped = [], [], [], [], [], []
+    for hit in hits:
+        slide_id = hit['submitter_id'].replace('_slide_image', '')
+        path = _find_slide_path(hit, slide_id)
+        if path is None:
+            dropped.append(hit['file_id'])
             continue
-        # Inner loop was broken, break the outer.
-        break
 
-    return slide_json
+        files.append(hit)
+        cases.append(path[0])
+        samples.append(path[1])
+        slides.append(path[2])
+        slide_ids.append(slide_id)
 
+    if dropped:
+        print('WARNING! No slide found for file_ids: ', dropped)
 
-def _process_slide_json(file_json, fields):
-    
-    # Files data
-    file_data = {k: file_json.get(k) for k in fields['files']}
+    # Same precedence as merging files, cases, samples and slides data
+    columns = {}
+    for source, elems in [('files', files), ('cases', cases), ('samples', samples), ('slides', slides)]:
+        for field in fields[source]:
+            columns[field] = [elem.get(field) for elem in elems]
 
-    file_data['file_id'] = file_json['file_id']
-    file_data['slide_id'] = file_json['submitter_id'].replace('_slide_image', '')
-    file_data['case_id'] = file_json['submitter_id'][:12]
-    file_data['sample_id'] = file_json['submitter_id'][:16]
+    # File size to MB, rounded per value (pandas rounds some halves differently)
+    if 'file_size' in columns:
+        columns['file_size'] = [None if x is None else round(x / 10**6, 2) for x in columns['file_size']]
+
+    slides_df = pd.DataFrame(columns)
+
+    # object dtype so the columns exist with the right type even when no hit matches
+    slides_df['file_id'] = pd.Series([hit['file_id'] for hit in files], dtype=object)
+    slides_df['slide_id'] = pd.Series(slide_ids, dtype=object)
+    slides_df['case_id'] = pd.Series([x[:12] for x in slide_ids], dtype=object)
+    slides_df['sample_id'] = pd.Series([x[:16] for x in slide_ids], dtype=object)
+
+    return slides_df.drop_duplicates('file_id').reset_index(drop=True)
+
+
+def _parse_slides_page(content, fields):
+    return _flatten_slides_json(json.loads(content)['data']['hits'], fields)
 
-    if 'file_size' in file_data:
-        file_data['file_size'] = round(file_data['file_size'] / 10**6, 2)
-    
-    # Cases
-    if len(file_json['cases']) > 1:
-        case_json = find_elem_by_submitter_id(file_json['cases'], submitter_id=file_data['case_id'])
-    else:
-        case_json = file_json['cases'][0]
-    case_data = {k: case_json.get(k) for k in fields['cases']}
-    
-    # Samples
-    if len(case_json['samples']) > 1:
-        sample_json = find_elem_by_submitter_id(case_json['samples'], submitter_id=file_data['sample_id'])
-    else:
-        sample_json = case_json['samples'][0]
-    sample_data = {k: sample_json.get(k) for k in fields['samples']}
-
-    # Slides
-    slide_json = _find_slide(sample_json['portions'], file_data['slide_id'])
-    slide_data = {k: slide_json.get(k) for k in fields['slides']}
-    
-    # All
-    all_data = {**file_data, **case_data, **sample_data, **slide_data}
-    
-    return all_data
 
-def get_cases(filter_conf, fields, max_results=10000):
+def get_cases(filter_conf, fields, max_results=None, page_size=PAGE_SIZE, n_workers=N_WORKERS, 
+              cache=None):
 
     # Build query
     query_fields = ['submitter_id'] + fields['cases']
@@ -84,14 +184,10 @@ def get_cases(filter_conf, fields, max_results=10000):
 
     params = {'fields': ','.join(query_fields),
               'filters': query_filter, 
-              'format': 'TSV',
-              'size': max_results}
+              'format': 'TSV'}
 
     # Run query
-    response = requests.post(CASES_ENDPOINT, headers={'Content-Type': 'application/json'}, json=params)
-
-    # Build DF
-    cases_df = pd.read_csv(io.StringIO(response.content.decode('utf-8')), sep='\t')
+    cases_df = _fetch_tsv(CASES_ENDPOINT, params, max_results, page_size, n_workers, cache)
 
     _multiple_column_check(cases_df)
 
@@ -107,8 +203,9 @@ def get_cases(filter_conf, fields, max_results=10000):
     return cases_df
 
 
-def get_rnaseq_metadata(filter_conf, fields, max_results=10000, 
-                        workflow_types=['HTSeq - Counts', 'HTSeq - FPKM-UQ', 'HTSeq - FPKM']):
+def get_rnaseq_metadata(filter_conf, fields, max_results=None, 
+                        workflow_types=['HTSeq - Counts', 'HTSeq - FPKM-UQ', 'HTSeq - FPKM'], 
+                        page_size=PAGE_SIZE, n_workers=N_WORKERS, cache=None):
 
     # Build query
     id_fields = ['file_id', 'cases.submitter_id', 'cases.samples.submitter_id', 'submitter_id']
@@ -119,14 +216,10 @@ def get_rnaseq_metadata(filter_conf, fields, max_results=10000,
 
     params = {'fields': ','.join(query_fields),
               'filters': query_filter, 
-              'format': 'TSV',
-              'size': max_results}
+              'format': 'TSV'}
 
     # Run query
-    response = requests.post(FILES_ENDPOINT, headers={'Content-Type': 'application/json'}, json=params)
-
-    # Build DF
-    rnaseq_df = pd.read_csv(io.StringIO(response.content.decode('utf-8')), sep='\t')
+    rnaseq_df = _fetch_tsv(FILES_ENDPOINT, params, max_results, page_size, n_workers, cache)
 
     _multiple_column_check(rnaseq_df)
 
@@ -152,8 +245,9 @@ def get_rnaseq_metadata(filter_conf, fields, max_results=10000,
     return rnaseq_df
 
 
-def get_slides_metadata(filter_conf, fields, max_results=10000,
-                        experimental_strategies=['Tissue Slide', 'Diagnostic Slide']):
+def get_slides_metadata(filter_conf, fields, max_results=None,
+                        experimental_strategies=['Tissue Slide', 'Diagnostic Slide'], 
+                        page_size=PAGE_SIZE, n_workers=N_WORKERS, cache=None):
 
     # Build query
     id_fields = ['file_id', 'submitter_id', 'cases.submitter_id', 'cases.samples.submitter_id', 
@@ -166,22 +260,13 @@ def get_slides_metadata(filter_conf, fields, max_results=10000,
 
     params = {'fields': ','.join(query_fields),
               'filters': query_filter, 
-              'format': 'JSON',
-              'size': max_results}
-
-    # Run query
-    response_json = requests.post(FILES_ENDPOINT, headers={'Content-Type': 'application/json'}, json=params)
-    
-    response_json = json.loads(response_json.content)
-
-    # Process output
-    slides_data = []
+              'format': 'JSON'}
 
-    for hit in response_json['data']['hits']:
-        slide_data = _process_slide_json(hit, fields)
-        slides_data.append(slide_data)
+    # Run query and process each page as it arrives
+    parse_page = partial(_parse_slides_page, fields=fields)
+    pages = _fetch_pages(FILES_ENDPOINT, params, parse_page, max_results, page_size, n_workers, cache)
 
-    slides_df = pd.DataFrame(slides_data)
+    slides_df = pd.concat(pages, ignore_index=True, sort=False) if pages else _flatten_slides_json([], fields)
 
     # Reorganise columns
     id_columns = ['file_id', 'case_id', 'sample_id', 'slide_id']
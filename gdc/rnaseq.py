@@ -0,0 +1,39 @@
+import io
+import os
+from threading import Lock
+import pandas as pd
+
+
+class CountsStore(object):
+    """
+    Collects HTSeq files (gene_id, value) as the columns of a single genes x files matrix 
+    that is written to a columnar (parquet) file, instead of one text file per sample.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = Lock()
+        self._columns = {}
+
+        if os.path.exists(self.path):
+            self._columns = dict(pd.read_parquet(self.path).items())
+
+    def add(self, name, data):
+
+        counts = pd.read_csv(io.BytesIO(data), sep='\t', header=None, index_col=0).iloc[:, 0]
+        counts.index.name = 'gene_id'
+
+        with self._lock:
+            self._columns[name] = counts
+
+    def __contains__(self, name):
+        with self._lock:
+            return name in self._columns
+
+    def to_dataframe(self):
+
+        with self._lock:
+            return pd.DataFrame(self._columns)
+
+    def save(self):
+        self.to_dataframe().to_parquet(self.path)
@@ -0,0 +1,53 @@
+import heapq
+import pandas as pd
+
+# Single stream throughput (MB/s) measured in speed_tests/test_results.csv
+STREAM_SPEED = 4
+
+JOB_COLUMNS = ['file_id', 'file_name', 'file_size', 'md5sum', 'decompress']
+
+
+def estimate_makespan(sizes, n_workers, speed=STREAM_SPEED):
+    """
+    Simulates n_workers taking files (MB) in the given order as soon as they are free and 
+    returns the expected total time in seconds.
+    """
+
+    workers = [0.] * n_workers
+    for size in sizes:
+        start = heapq.heappop(workers)
+        heapq.heappush(workers, start + size / speed)
+
+    return max(workers)
+
+
+def plan_downloads(manifests, n_workers, speed=STREAM_SPEED, download_manifest=None, counts_store=None):
+    """
+    Merges several manifests ({output_dir: files_df}) into a single job list where every 
+    file_id appears once. Jobs are sorted by decreasing file_size (longest processing time 
+    first) so the big slides start first and the small files fill the gaps at the end. 
+    Files already complete in download_manifest are left out (stored files are checked 
+    against counts_store if given).
+    """
+
+    jobs = []
+    for output_dir, files_df in manifests.items():
+        columns = [x for x in JOB_COLUMNS if x in files_df.columns]
+        files_df = files_df[columns].copy()
+        files_df['output_dir'] = output_dir
+        jobs.append(files_df)
+
+    jobs = pd.concat(jobs, ignore_index=True)
+    jobs = jobs.drop_duplicates('file_id')
+
+    if 'decompress' in jobs.columns:
+        jobs['decompress'] = jobs['decompress'].fillna(False).astype(bool)
+
+    if download_manifest is not None:
+        jobs = pd.DataFrame(download_manifest.pending(jobs, counts_store=counts_store), columns=jobs.columns)
+
+    jobs = jobs.sort_values('file_size', ascending=False).reset_index(drop=True)
+
+    makespan = estimate_makespan(jobs['file_size'].values, n_workers, speed)
+
+    return jobs, makespan
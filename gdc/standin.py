@@ -0,0 +1,63 @@
+"""
+Local stand-in for the GDC API metadata endpoints. It answers the POST queries from the 
+responses stored in a ResponseCache, optionally recording the misses from the real API. 
+Setting GDC_API=http://<host>:<port> lets the metadata pipeline run offline.
+"""
+import json
+import argparse
+import requests
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from socketserver import ThreadingMixIn
+
+from gdc.cache import ResponseCache
+
+UPSTREAM_API = 'https://api.gdc.cancer.gov'
+
+
+class _StandInHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+
+        params = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        content = self.server.cache.get(self.path, params)
+
+        if (content is None) and self.server.upstream:
+            response = requests.post(self.server.upstream + self.path, json=params, 
+                                     headers={'Content-Type': 'application/json'})
+            if response.status_code == 200:
+                content = response.content
+                self.server.cache.set(self.path, params, content)
+
+        if content is None:
+            self.send_error(404, 'Query not found in cache')
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+
+class StandInServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, cache_dir, host='127.0.0.1', port=5050, upstream=None):
+        HTTPServer.__init__(self, (host, port), _StandInHandler)
+        self.cache = ResponseCache(cache_dir, ttl=None, max_size=float('inf'))
+        self.upstream = upstream
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser("GDC stand-in server")
+    parser.add_argument('cache_dir', help="Directory of the response cache", type=str)
+    parser.add_argument('-host', help="Address to listen on", type=str, default='127.0.0.1')
+    parser.add_argument('-port', help="Port to listen on", type=int, default=5050)
+    parser.add_argument('-record', help="Forward and store the queries not found in the cache", 
+                        action='store_true')
+
+    args = parser.parse_args()
+
+    server = StandInServer(args.cache_dir, args.host, args.port, UPSTREAM_API if args.record else None)
+    server.serve_forever()
@@ -1,3 +1,4 @@
+import hashlib
 import gzip
 import shutil
 
@@ -8,6 +9,7 @@ def find_elem_by_submitter_id(elements, submitter_id):
     for elem in elements:
         if submitter_id == elem['submitter_id']:
             result = elem
+            break
 
     if result == {}:
         print('Warning: {} not found!'.format(submitter_id))
@@ -17,4 +19,13 @@ def find_elem_by_submitter_id(elements, submitter_id):
 def gunzip(source_filepath, dest_filepath):
     with gzip.open(source_filepath, 'rb') as s_file:
         with open(dest_filepath, 'wb') as d_file:
-            shutil.copyfileobj(s_file, d_file)
\ No newline at end of file
+            shutil.copyfileobj(s_file, d_file)
+
+def md5_file(file_path, chunk_size=1024):
+    
+    md5 = hashlib.md5()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size*1024), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
@@ -0,0 +1,250 @@
+import numpy as np
+
+INDEX_EXT = '.npz'
+
+
+def kmeans(x, n_clusters, n_iter=20, seed=None):
+    """
+    Plain Lloyd's k-means. Returns the (n_clusters, dim) centroids.
+    """
+
+    random_state = np.random.RandomState(seed)
+    centroids = x[random_state.choice(len(x), n_clusters, replace=len(x) < n_clusters)].copy()
+
+    for _ in range(n_iter):
+        assignments = _nearest(x, centroids)
+        counts = np.bincount(assignments, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, x)
+
+        # Empty clusters keep their previous centroid
+        non_empty = counts > 0
+        centroids[non_empty] = sums[non_empty] / counts[non_empty, None]
+
+    return centroids
+
+
+def _nearest(x, centroids, chunk_size=10000):
+
+    assignments = np.empty(len(x), dtype='int64')
+    centroids_sq = np.sum(centroids ** 2, axis=1)
+
+    for start in range(0, len(x), chunk_size):
+        chunk = x[start:start + chunk_size]
+        assignments[start:start + chunk_size] = np.argmin(centroids_sq - 2 * chunk.dot(centroids.T), axis=1)
+
+    return assignments
+
+
+class LatentIndex(object):
+    """
+    Approximate nearest neighbour index (IVF-PQ) over latent vectors. Vectors are assigned
+    to one of n_lists coarse k-means centroids and their residual is compressed with product
+    quantization (n_subspaces uint8 codes). A query only scans the n_probe closest lists,
+    using lookup tables of distances to the PQ codebooks. The query time grows linearly with
+    n_probe (about 0.2 ms per list at 200k 64-d vectors and 256 lists), recall with it until
+    the PQ error dominates, so a larger n_probe can be passed to search when recall matters.
+    """
+
+    def __init__(self, n_lists=256, n_subspaces=16, n_codes=256, n_probe=2, seed=None):
+        if not 1 <= n_codes <= 256:
+            raise ValueError('n_codes must be between 1 and 256 (uint8 codes), got {}'.format(n_codes))
+
+        self.n_lists = n_lists
+        self.n_subspaces = n_subspaces
+        self.n_codes = n_codes
+        self.n_probe = n_probe
+        self.seed = seed
+
+        self.centroids = None
+        self.codebooks = None
+        self._ids = [[] for _ in range(n_lists)]
+        self._codes = [[] for _ in range(n_lists)]
+        self._id_location = None
+
+    def _split(self, x):
+        return x.reshape(len(x), self.n_subspaces, -1)
+
+    def train(self, vectors, max_samples=50000, n_iter=20):
+        """
+        Fits the coarse centroids and the PQ codebooks on (a sample of) vectors.
+        """
+
+        vectors = np.asarray(vectors, dtype='float32')
+        if vectors.shape[1] % self.n_subspaces:
+            raise ValueError('Latent dimension {} is not divisible by {} subspaces'.format(
+                                 vectors.shape[1], self.n_subspaces))
+
+        random_state = np.random.RandomState(self.seed)
+        if len(vectors) > max_samples:
+            vectors = vectors[np.sort(random_state.choice(len(vectors), max_samples, replace=False))]
+
+        self.centroids = kmeans(vectors, self.n_lists, n_iter, self.seed)
+        residuals = self._split(vectors - self.centroids[_nearest(vectors, self.centroids)])
+
+        self.codebooks = np.stack([kmeans(residuals[:, m], self.n_codes, n_iter, self.seed)
+                                   for m in range(self.n_subspaces)])
+        self._precompute()
+
+    def _precompute(self):
+
+        self._centroids_sq = np.sum(self.centroids ** 2, axis=1)
+        self._codebooks_sq = np.sum(self.codebooks ** 2, axis=2)
+
+    def _encode(self, residuals):
+
+        residuals = self._split(residuals)
+        codes = np.empty(residuals.shape[:2], dtype='uint8')
+        for m in range(self.n_subspaces):
+            codes[:, m] = _nearest(residuals[:, m], self.codebooks[m])
+
+        return codes
+
+    def add(self, vectors, ids):
+        """
+        Adds vectors with their integer ids (e.g. their row in an EmbeddingStore).
+        """
+
+        vectors = np.asarray(vectors, dtype='float32')
+        ids = np.asarray(ids, dtype='int64')
+
+        lists = _nearest(vectors, self.centroids)
+        codes = self._encode(vectors - self.centroids[lists])
+
+        for l in np.unique(lists):
+            mask = lists == l
+            self._ids[l].append(ids[mask])
+            # Codes are kept transposed (n_subspaces, n) so each subspace is contiguous
+            self._codes[l].append(np.ascontiguousarray(codes[mask].T))
+
+        self._id_location = None
+
+    def add_store(self, embeddings, batch_size=100000):
+        """
+        Adds the rows of an EmbeddingStore not indexed yet, using the row number as id.
+        Can be called again as more slides are encoded.
+        """
+
+        for start in range(len(self), embeddings.done, batch_size):
+            end = min(start + batch_size, embeddings.done)
+            self.add(embeddings.vectors[start:end], np.arange(start, end))
+
+    def _list(self, l):
+
+        # Appended chunks are merged on first use
+        if len(self._ids[l]) > 1:
+            self._ids[l] = [np.concatenate(self._ids[l])]
+            self._codes[l] = [np.concatenate(self._codes[l], axis=1)]
+
+        if not self._ids[l]:
+            return np.empty(0, dtype='int64'), np.empty((self.n_subspaces, 0), dtype='uint8')
+
+        return self._ids[l][0], self._codes[l][0]
+
+    def __len__(self):
+        return sum(len(ids) for chunks in self._ids for ids in chunks)
+
+    def reconstruct(self, patch_id):
+        """
+        Approximate vector of an indexed id, decoded from its PQ code.
+        """
+
+        if self._id_location is None:
+            self._id_location = {}
+            for l in range(self.n_lists):
+                for pos, i in enumerate(self._list(l)[0]):
+                    self._id_location[i] = (l, pos)
+
+        l, pos = self._id_location[patch_id]
+        codes = self._list(l)[1][:, pos]
+
+        return self.centroids[l] + self.codebooks[np.arange(self.n_subspaces), codes].ravel()
+
+    def search(self, query, k=10, n_probe=None):
+        """
+        Returns the ids and approximate squared distances of the k nearest indexed vectors.
+        """
+
+        query = np.asarray(query, dtype='float32').ravel()
+        n_probe = n_probe or self.n_probe
+
+        coarse_dists = self._centroids_sq - 2 * self.centroids.dot(query)
+        probe = np.argpartition(coarse_dists, n_probe - 1)[:n_probe] if n_probe < self.n_lists \
+                else np.arange(self.n_lists)
+
+        # Distances from each probed residual sub-vector to every codeword: 
+        # (n_probe, n_subspaces, n_codes)
+        residuals = self._split(query - self.centroids[probe])
+        tables = (self._codebooks_sq - 2 * np.einsum('pmd,mcd->pmc', residuals, self.codebooks) + 
+                  np.sum(residuals ** 2, axis=2)[:, :, None]).astype('float32')
+
+        all_ids, all_dists = [], []
+        for l, table in zip(probe, tables):
+            ids, codes = self._list(l)
+            if not len(ids):
+                continue
+
+            dists = np.zeros(len(ids), dtype='float32')
+            for m in range(self.n_subspaces):
+                dists += table[m].take(codes[m])
+
+            all_ids.append(ids)
+            all_dists.append(dists)
+
+        if not all_ids:
+            return np.empty(0, dtype='int64'), np.empty(0, dtype='float32')
+
+        ids, dists = np.concatenate(all_ids), np.concatenate(all_dists)
+        top = np.argpartition(dists, k - 1)[:k] if len(dists) > k else np.arange(len(dists))
+        top = top[np.argsort(dists[top])]
+
+        return ids[top], dists[top]
+
+    def search_id(self, patch_id, k=10, n_probe=None):
+        """
+        Nearest neighbours of an indexed id (excluding itself).
+        """
+
+        ids, dists = self.search(self.reconstruct(patch_id), k + 1, n_probe)
+        mask = ids != patch_id
+
+        return ids[mask][:k], dists[mask][:k]
+
+    def search_patch(self, cae, patch, k=10, n_probe=None):
+        """
+        Nearest neighbours of a raw uint8 patch image, encoded with the CAE encoder.
+        """
+
+        x = np.asarray(patch, dtype='float32')[None] / 255
+
+        return self.search(cae.encode(x)[0], k, n_probe)
+
+    def save(self, path):
+
+        lists = [self._list(l) for l in range(self.n_lists)]
+        np.savez(path, centroids=self.centroids, codebooks=self.codebooks,
+                 ids=np.concatenate([ids for ids, _ in lists]),
+                 codes=np.concatenate([codes for _, codes in lists], axis=1),
+                 list_sizes=np.array([len(ids) for ids, _ in lists]),
+                 params=np.array([self.n_lists, self.n_subspaces, self.n_codes, self.n_probe]))
+
+    @classmethod
+    def load(cls, path):
+
+        data = np.load(path if path.endswith(INDEX_EXT) else path + INDEX_EXT)
+        n_lists, n_subspaces, n_codes, n_probe = data['params']
+
+        index = cls(int(n_lists), int(n_subspaces), int(n_codes), int(n_probe))
+        index.centroids = data['centroids']
+        index.codebooks = data['codebooks']
+        index._precompute()
+
+        # Each access to an npz member reads it again, so they are read once
+        ids, codes = data['ids'], data['codes']
+        bounds = np.r_[0, np.cumsum(data['list_sizes'])]
+        for l in range(index.n_lists):
+            if bounds[l + 1] > bounds[l]:
+                index._ids[l] = [ids[bounds[l]:bounds[l + 1]]]
+                index._codes[l] = [np.ascontiguousarray(codes[:, bounds[l]:bounds[l + 1]])]
+
+        return index
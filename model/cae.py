@@ -7,6 +7,16 @@ from keras.layers import Input, Dense, Flatten, Reshape, InputLayer
 from keras.layers import MaxPooling2D, UpSampling2D, Conv2D, Conv2DTranspose
 from keras.callbacks import BaseLogger
 
+from model.dataset import PatchDataset, PatchGenerator, ThroughputLogger, list_patch_files
+from model.embeddings import EmbeddingStore, patch_files_index
+from wsi.store import PatchStore, STORE_EXT
+
+try:
+    get_ipython()
+    from tqdm import tqdm_notebook as tqdm
+except:
+    from tqdm import tqdm
+
 class CAE:
 
     def __init__(self, input_shape=(128,128,3), latent_features=512, 
@@ -115,15 +125,95 @@ class CAE:
         self.decoder.save_weights(os.path.join(self.path, "decoder.h5"))
     
     
-    def fit(self, x, y, epochs=25, callbacks=[BaseLogger()], validation_split=0.1):
+    def fit(self, x, y=None, epochs=25, callbacks=[BaseLogger()], validation_split=0.1):
+        """
+        Trains the autoencoder on in memory arrays (y defaults to x), or on a PatchDataset or 
+        PatchGenerator, which are read lazily in batches.
+        """
+
+        if isinstance(x, (PatchDataset, PatchGenerator)):
+            train, validation = x.split(validation_split) if validation_split else (x, None)
+            try:
+                self.model.fit_generator(train, steps_per_epoch=len(train), epochs=epochs, 
+                                         validation_data=validation, 
+                                         validation_steps=len(validation) if validation else None, 
+                                         callbacks=callbacks)
+            finally:
+                # Stop the decoding threads of the generators created by split
+                if validation_split and isinstance(x, PatchGenerator):
+                    train.close()
+                    validation.close()
+            return
 
+        y = x if y is None else y
         self.model.fit(x=x, y=y, epochs=epochs, validation_split=validation_split,
                        callbacks=callbacks)
 
         
+    def fit_patches(self, patches_dir, patching_results=None, batch_size=32, epochs=25, 
+                    validation_split=0.1, n_workers=4, prefetch=8, callbacks=[BaseLogger()]):
+        """
+        Trains the autoencoder streaming the png patches in patches_dir (optionally only 
+        from the slides in patching_results) decoded in background threads.
+        """
+
+        filenames = list_patch_files(patches_dir, patching_results)
+        generator = PatchGenerator(filenames, patches_dir, batch_size=batch_size, n_workers=n_workers, 
+                                   prefetch=prefetch)
+
+        try:
+            self.fit(generator, epochs=epochs, callbacks=callbacks + [ThroughputLogger()], 
+                     validation_split=validation_split)
+        finally:
+            generator.close()
+
+        
     def encode(self, inputs):
         return self.encoder.predict(inputs)
 
     
+    def encode_dataset(self, source, path, patching_results=None, batch_size=256, n_workers=4, 
+                       prefetch=8):
+        """
+        Encodes all the patches of a png patches directory or a PatchStore (.h5) in batches, 
+        writing the latent vectors to an EmbeddingStore at path. If the store already exists 
+        the encoding resumes after the last batch written.
+        """
+
+        if source.endswith(STORE_EXT):
+            with PatchStore(source) as store:
+                index = store.index()
+        else:
+            filenames = list_patch_files(source, patching_results)
+            index = patch_files_index(filenames)
+
+        # Without a dense latent layer the encoder outputs a feature map, stored flattened
+        embeddings = EmbeddingStore(path, index, int(np.prod(self.encoder.output_shape[1:])))
+        start = embeddings.done
+
+        if start == len(embeddings):
+            return embeddings
+
+        if source.endswith(STORE_EXT):
+            batches = PatchDataset(source, batch_size=batch_size, shuffle=False, 
+                                   indices=np.arange(start, len(embeddings)))
+        else:
+            batches = PatchGenerator(filenames[start:], source, batch_size=batch_size, shuffle=False, 
+                                     n_workers=n_workers, prefetch=prefetch)
+
+        try:
+            for i in tqdm(range(len(batches)), desc='Encoding'):
+                x, _ = batches[i] if isinstance(batches, PatchDataset) else next(batches)
+                vectors = self.encoder.predict_on_batch(x)
+                vectors = vectors.reshape(len(vectors), -1)
+                embeddings.write(start, vectors)
+                start += len(vectors)
+        finally:
+            if isinstance(batches, PatchGenerator):
+                batches.close()
+
+        return embeddings
+
+
     def decode(self, codes):
         return self.decoder.predict(codes)
\ No newline at end of file
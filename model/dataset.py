@@ -0,0 +1,220 @@
+import os
+import time
+import numpy as np
+import pandas as pd
+from queue import Queue
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from matplotlib import image as mpimage
+from keras.utils import Sequence
+from keras.callbacks import Callback
+
+from wsi.store import PatchStore, STORE_EXT
+
+
+def build_patch_array(filenames, path, directory=None, patch_shape=(128, 128, 3)):
+    """
+    Writes a list of patch images to a uint8 .npy file one by one, so it can be memory 
+    mapped without loading all the patches in RAM.
+    """
+
+    patches = np.lib.format.open_memmap(path, mode='w+', dtype='uint8', 
+                                        shape=(len(filenames),) + tuple(patch_shape))
+
+    for i, filename in enumerate(filenames):
+        filename = os.path.join(directory, filename) if directory else filename
+        img_array = mpimage.imread(filename)
+
+        # matplotlib reads png files as floats in [0, 1]
+        if img_array.dtype != np.uint8:
+            img_array = (img_array * 255).round().astype('uint8')
+
+        patches[i] = img_array[..., :patch_shape[2]]
+
+    patches.flush()
+
+    return path
+
+
+class PatchDataset(Sequence):
+    """
+    Shuffled mini-batches of patches read lazily from a memory-mapped uint8 .npy file, a 
+    PatchStore (.h5) or an array. Batches are normalized to float32 in [0, 1] and returned 
+    as (x, x) pairs to train the autoencoder.
+    """
+
+    def __init__(self, source, batch_size=32, shuffle=True, indices=None, seed=None):
+
+        if isinstance(source, str) and source.endswith(STORE_EXT):
+            self.data = PatchStore(source)
+        elif isinstance(source, str):
+            self.data = np.load(source, mmap_mode='r')
+        else:
+            self.data = source
+
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.random_state = np.random.RandomState(seed)
+        self.indices = np.arange(len(self.data)) if indices is None else np.asarray(indices)
+
+        if self.shuffle:
+            self.random_state.shuffle(self.indices)
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def __getitem__(self, batch):
+
+        # Sorted reads are sequential on disk
+        idx = np.sort(self.indices[batch * self.batch_size:(batch + 1) * self.batch_size])
+        x = np.asarray(self.data[idx], dtype='float32') / 255
+
+        return x, x
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.random_state.shuffle(self.indices)
+
+    def split(self, validation_split=0.1):
+        """
+        Splits the patches in two datasets (train, validation) sharing the same data.
+        """
+
+        n_validation = int(round(len(self.indices) * validation_split))
+        indices = self.indices.copy()
+        self.random_state.shuffle(indices)
+
+        train = PatchDataset(self.data, self.batch_size, self.shuffle, indices[n_validation:], 
+                             self.random_state.randint(2**31))
+        validation = PatchDataset(self.data, self.batch_size, False, indices[:n_validation])
+
+        return train, validation
+
+
+def list_patch_files(patches_dir, patching_results=None):
+    """
+    Lists the png patches in patches_dir (named <slide>_<row>_<col>.png), keeping only 
+    the slides in patching_results (DataFrame or path to patching_results.csv) if given.
+    """
+
+    filenames = sorted(f for f in os.listdir(patches_dir) if f.endswith('.png'))
+
+    if patching_results is not None:
+        if isinstance(patching_results, str):
+            patching_results = pd.read_csv(patching_results, sep='|')
+        slides = set(patching_results['file'].str.replace('.svs', '', regex=False))
+        filenames = [f for f in filenames if f.rsplit('_', 2)[0] in slides]
+
+    return filenames
+
+
+def _decode_batch(filenames, directory):
+
+    batch = [np.asarray(Image.open(os.path.join(directory, f)).convert('RGB')) for f in filenames]
+    x = np.array(batch, dtype='float32') / 255
+
+    return x, x
+
+
+class PatchGenerator(object):
+    """
+    Endless generator of (x, x) batches of png patches. Batches are decoded by a pool of 
+    n_workers threads and kept in a queue of at most prefetch batches, so training does 
+    not wait on png decoding.
+    """
+
+    def __init__(self, filenames, directory, batch_size=32, shuffle=True, n_workers=4, prefetch=8, 
+                 seed=None):
+        self.filenames = np.asarray(filenames)
+        self.directory = directory
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.n_workers = n_workers
+        self.prefetch = prefetch
+        self.seed = seed
+        self.random_state = np.random.RandomState(seed)
+
+        self._queue = None
+        self._closed = False
+        self._lock = Lock()
+
+    def __len__(self):
+        return int(np.ceil(len(self.filenames) / self.batch_size))
+
+    def _produce(self):
+
+        with ThreadPoolExecutor(max_workers=self.n_workers) as executor:
+            while not self._closed:
+                filenames = self.filenames.copy()
+                if self.shuffle:
+                    self.random_state.shuffle(filenames)
+
+                for i in range(len(self)):
+                    if self._closed:
+                        break
+                    batch = filenames[i * self.batch_size:(i + 1) * self.batch_size]
+                    # Blocks when the queue is full
+                    self._queue.put(executor.submit(_decode_batch, batch, self.directory))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+
+        with self._lock:
+            if self._queue is None:
+                self._queue = Queue(maxsize=self.prefetch)
+                Thread(target=self._produce, daemon=True).start()
+
+            future = self._queue.get()
+
+        return future.result()
+
+    def close(self):
+        """
+        Stops the background decoding.
+        """
+
+        self._closed = True
+        if self._queue is not None:
+            # Unblock the producer if it is waiting on a full queue
+            while not self._queue.empty():
+                self._queue.get()
+
+    def split(self, validation_split=0.1):
+        """
+        Splits the patches in two generators (train, validation).
+        """
+
+        filenames = self.filenames.copy()
+        self.random_state.shuffle(filenames)
+        n_validation = int(round(len(filenames) * validation_split))
+
+        train = PatchGenerator(filenames[n_validation:], self.directory, self.batch_size, self.shuffle, 
+                               self.n_workers, self.prefetch, self.seed)
+        validation = PatchGenerator(filenames[:n_validation], self.directory, self.batch_size, False, 
+                                    max(1, self.n_workers // 2), self.prefetch)
+
+        return train, validation
+
+
+class ThroughputLogger(Callback):
+    """
+    Reports the training throughput (patches/s) of each epoch.
+    """
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.time()
+        self.n_patches = 0
+
+    def on_batch_end(self, batch, logs=None):
+        self.n_patches += (logs or {}).get('size', 0)
+
+    def on_epoch_end(self, epoch, logs=None):
+
+        patches_per_sec = self.n_patches / max(time.time() - self.start, 1e-6)
+        print('Epoch {}: {:.1f} patches/s'.format(epoch + 1, patches_per_sec))
+
+        if logs is not None:
+            logs['patches_per_sec'] = patches_per_sec
@@ -0,0 +1,104 @@
+import os
+import numpy as np
+import pandas as pd
+
+INDEX_COLUMNS = ['slide', 'row', 'col']
+
+
+def patch_files_index(filenames):
+    """
+    Builds the (slide, row, col) index of a list of patch files named <slide>_<row>_<col>.png
+    """
+
+    parts = [os.path.splitext(os.path.basename(f))[0].rsplit('_', 2) for f in filenames]
+    index_df = pd.DataFrame(parts, columns=INDEX_COLUMNS)
+    index_df[['row', 'col']] = index_df[['row', 'col']].astype('int32')
+
+    return index_df
+
+
+class EmbeddingStore(object):
+    """
+    Latent vectors of a set of patches written incrementally to a memory-mapped float32
+    <path>.npy file, with the (slide, row, col) key of each row in <path>_index.csv and the
+    number of rows already written in <path>.progress, so an interrupted encoding can be
+    resumed.
+    """
+
+    def __init__(self, path, index=None, latent_features=None):
+        self.path = path
+        self.vectors_path = path + '.npy'
+        self.index_path = path + '_index.csv'
+        self.progress_path = path + '.progress'
+
+        if os.path.exists(self.vectors_path):
+            self.vectors = np.load(self.vectors_path, mmap_mode='r+')
+            self.index = pd.read_csv(self.index_path, dtype={'slide': str})
+            if index is not None and len(index) != len(self.index):
+                raise ValueError('{} has {} patches, expected {}'.format(self.vectors_path,
+                                                                        len(self.index), len(index)))
+        else:
+            if index is None or latent_features is None:
+                raise ValueError('index and latent_features are needed to create ' + self.vectors_path)
+
+            self.index = index[INDEX_COLUMNS].reset_index(drop=True)
+            self.index.to_csv(self.index_path, index=False)
+            self.vectors = np.lib.format.open_memmap(self.vectors_path, mode='w+', dtype='float32',
+                                                     shape=(len(self.index), latent_features))
+            self._set_done(0)
+
+    @property
+    def done(self):
+        with open(self.progress_path) as f:
+            return int(f.read())
+
+    def _set_done(self, done):
+
+        with open(self.progress_path + '.tmp', 'w') as f:
+            f.write(str(done))
+        os.replace(self.progress_path + '.tmp', self.progress_path)
+
+    def write(self, start, vectors):
+
+        self.vectors[start:start + len(vectors)] = vectors
+        self.vectors.flush()
+        # Progress is only recorded once the vectors are on disk
+        self._set_done(start + len(vectors))
+
+    def __len__(self):
+        return len(self.index)
+
+    def is_complete(self):
+        return self.done == len(self)
+
+
+def pool_slides(store, chunk_size=100000):
+    """
+    Mean and max pooling of the latent vectors of each slide, reading the store in chunks.
+    Returns a DataFrame indexed by slide with mean_<i> and max_<i> columns.
+    """
+
+    codes, slides = pd.factorize(store.index['slide'])
+    n_features = store.vectors.shape[1]
+
+    sums = np.zeros((len(slides), n_features), dtype='float64')
+    maxs = np.full((len(slides), n_features), -np.inf, dtype='float32')
+
+    for start in range(0, store.done, chunk_size):
+        chunk = np.asarray(store.vectors[start:min(start + chunk_size, store.done)])
+        chunk_codes = codes[start:start + len(chunk)]
+
+        # Patches of a slide are usually contiguous, so each run of equal codes is reduced at once
+        starts = np.flatnonzero(np.r_[True, chunk_codes[1:] != chunk_codes[:-1]])
+        np.add.at(sums, chunk_codes[starts], np.add.reduceat(chunk, starts, axis=0))
+        np.maximum.at(maxs, chunk_codes[starts], np.maximum.reduceat(chunk, starts, axis=0))
+
+    done_counts = np.bincount(codes[:store.done], minlength=len(slides))
+    means = sums / np.maximum(done_counts, 1)[:, None]
+
+    pooled_df = pd.DataFrame(np.hstack([means, maxs]), index=pd.Index(slides, name='slide'),
+                             columns=['mean_{}'.format(i) for i in range(n_features)] +
+                                     ['max_{}'.format(i) for i in range(n_features)])
+    pooled_df.insert(0, 'n_patches', done_counts)
+
+    return pooled_df[done_counts > 0]
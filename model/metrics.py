@@ -1,38 +1,57 @@
 import numpy as np
 
 
-def entropy(probs):
-    terms = probs * np.log2(probs)
+def entropy(probs, axis=-1):
+    with np.errstate(divide='ignore', invalid='ignore'):
+        terms = probs * np.log2(probs)
     terms[np.isnan(terms)] = 0
-    return -np.sum(terms)
-
-def gini(probs):
-    return 1 - np.sum(probs ** 2)
-
-
-def cluster_entropy(y_clusters, y_labels, output='average'):
-    
-    cluster_entropies = {}
-
-    for cluster in np.unique(y_clusters):
-        
-        cluster_labels = y_labels[y_clusters == cluster]
-        probs = np.bincount(cluster_labels) / len(cluster_labels)
-        
-        cluster_entropies[cluster] = entropy(probs)
-        
-    return cluster_entropies
-
-
-def cluster_gini(y_clusters, y_labels):
-    
-    cluster_ginis = {}
-    
-    for cluster in np.unique(y_clusters):
-        
-        cluster_labels = y_labels[y_clusters == cluster]
-        probs = np.bincount(cluster_labels) / len(cluster_labels)
-
-        cluster_ginis[cluster] = gini(probs)
-        
-    return cluster_ginis
\ No newline at end of file
+    return -np.sum(terms, axis=axis)
+
+def gini(probs, axis=-1):
+    return 1 - np.sum(probs ** 2, axis=axis)
+
+
+def contingency_table(y_clusters, y_labels):
+    """
+    Counts of each label in each cluster, built in a single pass with np.bincount.
+    Returns the sorted unique clusters and the (n_clusters, n_labels) table.
+    """
+
+    clusters, cluster_idx = np.unique(y_clusters, return_inverse=True)
+    labels, label_idx = np.unique(y_labels, return_inverse=True)
+
+    counts = np.bincount(cluster_idx.ravel() * len(labels) + label_idx.ravel(),
+                         minlength=len(clusters) * len(labels))
+
+    return clusters, counts.reshape(len(clusters), len(labels))
+
+
+def _cluster_scores(score_fn, y_clusters, y_labels, output):
+
+    clusters, table = contingency_table(y_clusters, y_labels)
+    sizes = table.sum(axis=1)
+    scores = score_fn(table / sizes[:, None])
+
+    if output == 'average':
+        # Clusters weighted by their number of samples
+        return np.sum(scores * sizes) / np.sum(sizes)
+
+    return dict(zip(clusters, scores))
+
+
+def cluster_entropy(y_clusters, y_labels, output='clusters'):
+    """
+    Entropy of the labels in each cluster ({cluster: entropy}) or, with output='average',
+    its average weighted by cluster size.
+    """
+
+    return _cluster_scores(entropy, y_clusters, y_labels, output)
+
+
+def cluster_gini(y_clusters, y_labels, output='clusters'):
+    """
+    Gini impurity of the labels in each cluster ({cluster: gini}) or, with
+    output='average', its average weighted by cluster size.
+    """
+
+    return _cluster_scores(gini, y_clusters, y_labels, output)
@@ -0,0 +1,135 @@
+import os
+import json
+import openslide
+import pandas as pd
+try:
+    get_ipython()
+    from tqdm import tqdm_notebook as tqdm
+except:
+    from tqdm import tqdm
+
+CATALOG_FILE = 'slide_catalog.json'
+
+
+def read_slide_info(slide_file):
+    """
+    Pyramid geometry, magnification, MPP and file size/mtime of a slide.
+    """
+
+    st = os.stat(slide_file)
+    os_img = openslide.open_slide(slide_file)
+
+    try:
+        mpp = (float(os_img.properties[openslide.PROPERTY_NAME_MPP_X]) +
+               float(os_img.properties[openslide.PROPERTY_NAME_MPP_Y])) / 2
+    except (KeyError, ValueError):
+        mpp = None
+
+    info = {'file_name': os.path.basename(slide_file),
+            'file_size': st.st_size,
+            'mtime': st.st_mtime,
+            'app_mag': os_img.properties.get('aperio.AppMag'),
+            'mpp': mpp,
+            'level_count': os_img.level_count,
+            'level_downsamples': list(os_img.level_downsamples),
+            'level_dimensions': [list(dim) for dim in os_img.level_dimensions]}
+    os_img.close()
+
+    return info
+
+
+class SlideInfo(object):
+    """
+    Catalog entry of a slide. Exposes the OpenSlide attributes used to plan patches
+    (properties, level_count, level_downsamples, level_dimensions, dimensions), so it can
+    stand in for an OpenSlide object in get_slide_patches_params.
+    """
+
+    def __init__(self, info):
+        self.info = info
+        self.properties = {'aperio.AppMag': info['app_mag']} if info['app_mag'] else {}
+        self.level_count = info['level_count']
+        self.level_downsamples = tuple(info['level_downsamples'])
+        self.level_dimensions = tuple(tuple(dim) for dim in info['level_dimensions'])
+        self.dimensions = self.level_dimensions[0]
+
+
+class SlideCatalog(object):
+    """
+    Slide metadata keyed by file name, stored as json. refresh only reopens the slides
+    that are new or whose size or mtime changed.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.slides = {}
+
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.slides = json.load(f)
+
+    def _is_current(self, file_name, slide_file):
+
+        info = self.slides.get(file_name)
+        if info is None:
+            return False
+
+        st = os.stat(slide_file)
+        return (info['file_size'] == st.st_size) & (info['mtime'] == st.st_mtime)
+
+    def refresh(self, slides_dir, file_names=None):
+        """
+        Updates the catalog with the slides in slides_dir (or only file_names), removing the
+        ones no longer there. Returns the number of slides read.
+        """
+
+        if file_names is None:
+            file_names = sorted(f for f in os.listdir(slides_dir)
+                                if openslide.OpenSlide.detect_format(os.path.join(slides_dir, f)))
+
+        file_names = [f for f in file_names if os.path.exists(os.path.join(slides_dir, f))]
+        changed = [f for f in file_names if not self._is_current(f, os.path.join(slides_dir, f))]
+
+        slides = {f: info for f, info in self.slides.items() 
+                  if os.path.exists(os.path.join(slides_dir, f))}
+        for file_name in tqdm(changed, unit='file'):
+            slides[file_name] = read_slide_info(os.path.join(slides_dir, file_name))
+
+        self.slides = slides
+        self.save()
+
+        return len(changed)
+
+    def save(self):
+
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self.slides, f)
+        os.replace(tmp_path, self.path)
+
+    def __contains__(self, file_name):
+        return file_name in self.slides
+
+    def __len__(self):
+        return len(self.slides)
+
+    def get(self, file_name):
+        return SlideInfo(self.slides[file_name]) if file_name in self.slides else None
+
+    def to_dataframe(self, slides_df=None):
+        """
+        One row per slide (the level lists are kept as lists), joined to slides_df (as in
+        slides_metadata.csv) by file_name if given.
+        """
+
+        catalog_df = pd.DataFrame(list(self.slides.values()),
+                                  columns=['file_name', 'file_size', 'mtime', 'app_mag', 'mpp',
+                                           'level_count', 'level_downsamples', 'level_dimensions'])
+        catalog_df['width'] = catalog_df['level_dimensions'].map(lambda x: x[0][0])
+        catalog_df['height'] = catalog_df['level_dimensions'].map(lambda x: x[0][1])
+
+        if slides_df is None:
+            return catalog_df
+
+        # slides_metadata.csv already has a file_size column (from the GDC)
+        return slides_df.merge(catalog_df, on='file_name', how='left', suffixes=('', '_local'))
@@ -4,6 +4,9 @@ import os
 import openslide
 import numpy as np
 import pandas as pd
+from functools import partial
+from collections import OrderedDict
+from multiprocessing import Pool
 try:
     get_ipython()
     from tqdm import tqdm_notebook as tqdm
@@ -12,31 +15,23 @@ except:
 
 from wsi.filter import filter_greys, filter_whites
 from wsi.filter import get_white_pixel_percetange
+from wsi.slide import tissue_mask
+from wsi.store import PatchStore, STORE_EXT
 
 
-def _fix_location_bug(location, height_shift, width_shift, level_downsample):
+def _fix_location_bug(x, y, rows, cols, level_downsample):
+    """
+    Shifts the first row (except its first patch) down and the first column (except its 
+    first patch) right by int(level_downsample) pixels.
+    """
 
-    if (height_shift == 0) & (width_shift != 0):
-        location[1] += int(level_downsample)
-    elif (height_shift != 0) & (width_shift == 0):
-        location[0] += int(level_downsample)
+    y += int(level_downsample) * ((rows == 0) & (cols != 0))
+    x += int(level_downsample) * ((rows != 0) & (cols == 0))
 
-    return location
+    return x, y
 
 
-def _read_patch(image, params, patch_size, output='array'):
-
-    patch_img = image.read_region(params['location'], params['level'], params['level_patch_size'])
-    if params['resize'] > 1:
-        patch_img = patch_img.resize((patch_size,patch_size), PIL.Image.LANCZOS)
-
-    if output == 'array':
-        return np.asarray(patch_img.convert('RGB'))
-    else:
-        return patch_img
-
-
-def get_slide_patches_params(image, patch_size, magnification):
+def _get_level_params(image, patch_size, magnification):
 
     original_magnification = int(image.properties['aperio.AppMag'])
     levels_magnification = [original_magnification/int(x) for x in image.level_downsamples]
@@ -53,28 +48,200 @@ def get_slide_patches_params(image, patch_size, magnification):
     level_downsample = image.level_downsamples[best_level]
     level_width, level_height = image.level_dimensions[best_level]
 
-    patches = []
+    return best_level, resize, level_patch_size, level_downsample, level_width, level_height
+
+
+def _contiguous_runs(grid, max_run=32):
+    """
+    Splits a PatchGrid in runs of at most max_run horizontally adjacent patches of the same 
+    row.
+    """
+
+    if len(grid) == 0:
+        return
+
+    x, y = grid.cells['x'], grid.cells['y']
+    step = grid.level_patch_size * grid.level_downsample
+
+    breaks = np.r_[True, (y[1:] != y[:-1]) | (np.abs(x[1:] - (x[:-1] + step)) >= 1)]
+    run_starts = np.flatnonzero(breaks)
+
+    # Position of each patch in its run, to also break runs longer than max_run
+    positions = np.arange(len(grid)) - np.repeat(run_starts, np.diff(np.r_[run_starts, len(grid)]))
+    starts = np.flatnonzero(breaks | (positions % max_run == 0))
+
+    for start, end in zip(starts, np.r_[starts[1:], len(grid)]):
+        yield grid[start:end]
+
+
+def _read_patch_run(image, run, patch_size):
+    """
+    Reads a run of adjacent patches with a single read_region and resize, and returns each 
+    patch as a view of the region array.
+    """
+
+    level_patch_size = run.level_patch_size
+    location = (int(run.cells['x'][0]), int(run.cells['y'][0]))
+
+    region = image.read_region(location, run.level, (level_patch_size * len(run), level_patch_size))
+
+    width = level_patch_size
+    if run.resize > 1:
+        width = patch_size
+        region = region.resize((patch_size * len(run), patch_size), PIL.Image.LANCZOS)
+
+    region = np.asarray(region.convert('RGB'))
+
+    return [region[:, i*width:(i+1)*width] for i in range(len(run))]
+
 
-    for height_shift in range(0, int(round(level_height / level_patch_size))):
-        for width_shift in range(0, int(round(level_width / level_patch_size))):
+GRID_DTYPE = [('row', 'int32'), ('col', 'int32'), ('x', 'int64'), ('y', 'int64')]
 
-            location = [int(width_shift * level_patch_size * level_downsample), 
-                        int(height_shift * level_patch_size * level_downsample)]
 
-            location = _fix_location_bug(location, height_shift, width_shift, level_downsample)
+class PatchGrid(object):
+    """
+    Grid of patches of a slide at the level chosen for a magnification. The cells are a 
+    structured array of (row, col, x, y), only built when first needed and only for the 
+    selected rows; iterating goes row by row. Indexing with an int returns the params dict 
+    of a patch, and with a slice, mask or indices a PatchGrid of those patches.
+    """
 
-            patches.append({'index': (height_shift, width_shift),
-                            'location': location, 
-                            'level': best_level,
-                            'level_patch_size': (level_patch_size, level_patch_size),
-                            'patch_size': (patch_size, patch_size),
-                            'resize': resize})
+    def __init__(self, level, level_downsample, level_patch_size, patch_size, resize, 
+                 n_rows, n_cols, rows=None, cells=None):
+        self.level = level
+        self.level_downsample = level_downsample
+        self.level_patch_size = level_patch_size
+        self.patch_size = patch_size
+        self.resize = resize
+        self.n_rows = n_rows
+        self.n_cols = n_cols
+        self.row_range = rows if rows is not None else (0, n_rows)
+        self._cells = cells
 
-    return patches
+    def _build_cells(self, start, stop):
+
+        rows, cols = np.meshgrid(np.arange(start, stop, dtype='int64'), 
+                                 np.arange(self.n_cols, dtype='int64'), indexing='ij')
+        rows, cols = rows.ravel(), cols.ravel()
+
+        x = (cols * self.level_patch_size * self.level_downsample).astype('int64')
+        y = (rows * self.level_patch_size * self.level_downsample).astype('int64')
+        x, y = _fix_location_bug(x, y, rows, cols, self.level_downsample)
+
+        cells = np.empty(len(rows), dtype=GRID_DTYPE)
+        cells['row'], cells['col'], cells['x'], cells['y'] = rows, cols, x, y
+
+        return cells
+
+    @property
+    def cells(self):
+        if self._cells is None:
+            self._cells = self._build_cells(*self.row_range)
+        return self._cells
+
+    def _subset(self, cells):
+        return PatchGrid(self.level, self.level_downsample, self.level_patch_size, 
+                         self.patch_size, self.resize, self.n_rows, self.n_cols, 
+                         self.row_range, cells)
+
+    def rows(self, start, stop):
+        """
+        Grid restricted to the rows [start, stop).
+        """
+
+        if self._cells is not None:
+            mask = (self._cells['row'] >= start) & (self._cells['row'] < stop)
+            return self._subset(self._cells[mask])
+
+        start, stop = max(start, self.row_range[0]), min(stop, self.row_range[1])
+        return PatchGrid(self.level, self.level_downsample, self.level_patch_size, 
+                         self.patch_size, self.resize, self.n_rows, self.n_cols, 
+                         (start, max(start, stop)))
+
+    def __len__(self):
+        if self._cells is not None:
+            return len(self._cells)
+        return (self.row_range[1] - self.row_range[0]) * self.n_cols
+
+    def _params(self, cell):
+        return {'index': (int(cell['row']), int(cell['col'])),
+                'location': [int(cell['x']), int(cell['y'])], 
+                'level': self.level,
+                'level_downsample': self.level_downsample,
+                'level_patch_size': (self.level_patch_size, self.level_patch_size),
+                'patch_size': (self.patch_size, self.patch_size),
+                'resize': self.resize}
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self._params(self.cells[idx])
+        return self._subset(self.cells[idx])
+
+    def __iter__(self):
+        if self._cells is not None:
+            for cell in self._cells:
+                yield self._params(cell)
+        else:
+            for row in range(*self.row_range):
+                for cell in self._build_cells(row, row + 1):
+                    yield self._params(cell)
+
+
+def get_slide_patches_params(image, patch_size, magnification):
+    """
+    PatchGrid of the patches of the slide (an OpenSlide image or a SlideInfo from the 
+    catalog) at the given magnification.
+    """
+
+    best_level, resize, level_patch_size, level_downsample, level_width, level_height = \
+        _get_level_params(image, patch_size, magnification)
+
+    return PatchGrid(best_level, level_downsample, level_patch_size, patch_size, resize, 
+                     int(round(level_height / level_patch_size)), 
+                     int(round(level_width / level_patch_size)))
+
+
+def get_patches_tissue_fraction(image, patches_params, white_max_value=220):
+    """
+    Estimates the fraction of tissue of each patch from the tissue mask of the lowest 
+    resolution level, using an integral image of the mask.
+    """
+
+    mask = tissue_mask(image, white_max_value)
+    integral = np.pad(mask.cumsum(axis=0).cumsum(axis=1), ((1, 0), (1, 0)))
+
+    scale_x = mask.shape[1] / image.dimensions[0]
+    scale_y = mask.shape[0] / image.dimensions[1]
+
+    if isinstance(patches_params, PatchGrid):
+        locations = np.stack([patches_params.cells['x'], patches_params.cells['y']], axis=1)
+        locations = locations.astype(float)
+        sizes = patches_params.level_patch_size * image.level_downsamples[patches_params.level]
+    else:
+        locations = np.array([x['location'] for x in patches_params], dtype=float).reshape(-1, 2)
+        sizes = np.array([x['level_patch_size'][0] * image.level_downsamples[x['level']] 
+                          for x in patches_params], dtype=float)
+
+    x0 = np.clip(np.floor(locations[:, 0] * scale_x).astype(int), 0, mask.shape[1] - 1)
+    y0 = np.clip(np.floor(locations[:, 1] * scale_y).astype(int), 0, mask.shape[0] - 1)
+    x1 = np.clip(np.ceil((locations[:, 0] + sizes) * scale_x).astype(int), x0 + 1, mask.shape[1])
+    y1 = np.clip(np.ceil((locations[:, 1] + sizes) * scale_y).astype(int), y0 + 1, mask.shape[0])
+
+    tissue = integral[y1, x1] - integral[y0, x1] - integral[y1, x0] + integral[y0, x0]
+
+    return tissue / ((x1 - x0) * (y1 - y0))
 
 
 def patch_slide(image, output_dir, patch_size, magnification, white_pixel_thresh=20, 
-                sampling=1, white_max_value=220):
+                sampling=1, white_max_value=220, rows=None, mask_margin=10, max_run=32, output='png'):
+    """
+    Saves the patches of a slide with at most white_pixel_thresh % of white pixels. Unless 
+    mask_margin is None, patches whose white percentage estimated from the low resolution 
+    tissue mask exceeds white_pixel_thresh + mask_margin are discarded without being read. 
+    Runs of up to max_run adjacent patches are read with a single read_region. Patches are 
+    saved as one png each or, with output='hdf5', appended to a PatchStore per slide (or 
+    per shard of rows).
+    """
 
     white_pixel_thresh = white_pixel_thresh if white_pixel_thresh else 100
 
@@ -85,44 +252,160 @@ def patch_slide(image, output_dir, patch_size, magnification, white_pixel_thresh
         opeslide_image = openslide.open_slide(image)
         file_name = image.rsplit('/')[-1] 
     
-    patches_params = get_slide_patches_params(opeslide_image, patch_size, magnification)
+    grid = get_slide_patches_params(opeslide_image, patch_size, magnification)
+
+    # Only a shard of grid rows [start, stop)
+    if rows is not None:
+        grid = grid.rows(*rows)
+
+    if (mask_margin is not None) & (white_pixel_thresh < 100) & (len(grid) > 0):
+        white_estimate = 100 * (1 - get_patches_tissue_fraction(opeslide_image, grid, 
+                                                                 white_max_value))
+        skip = white_estimate > white_pixel_thresh + mask_margin
+    else:
+        skip = np.zeros(len(grid), dtype=bool)
+
+    sampled = np.random.uniform(size=len(grid)) < sampling
 
     n_saved = 0
-    n_total = 0
-    
-    for params in patches_params:
+    n_total = int(sampled.sum())
+
+    selected = grid[sampled & ~skip]
+
+    slide_name = file_name.replace('.svs', '')
+
+    if output == 'hdf5':
+        store_name = slide_name + ('_{:03d}_{:03d}'.format(*rows) if rows is not None else '')
+        store = PatchStore(os.path.join(output_dir, store_name + STORE_EXT), mode='w')
 
-        if np.random.uniform() >= sampling:
-            continue
+    # Adjacent patches are read together
+    for run in _contiguous_runs(selected, max_run):
 
-        patch_arr = _read_patch(opeslide_image, params, patch_size)
-        out_file_name = file_name.replace('.svs', '') + '_{:03d}_{:03d}.png'.format(*params['index'])
-        
-        blank_pixel_perc = get_white_pixel_percetange(patch_arr, white_max_value)
+        saved, saved_patches, saved_white_percs = [], [], []
+
+        for i, patch_arr in enumerate(_read_patch_run(opeslide_image, run, patch_size)):
+            
+            blank_pixel_perc = get_white_pixel_percetange(patch_arr, white_max_value)
+
+            if blank_pixel_perc > white_pixel_thresh:
+                continue
+
+            if output == 'hdf5':
+                saved.append(i)
+                saved_patches.append(patch_arr)
+                saved_white_percs.append(blank_pixel_perc)
+            else:
+                cell = run.cells[i]
+                out_file_name = slide_name + '_{:03d}_{:03d}.png'.format(cell['row'], cell['col'])
+                patch_img = Image.fromarray(patch_arr)
+                patch_img.save(os.path.join(output_dir, out_file_name))
 
-        if blank_pixel_perc <= white_pixel_thresh:
-            patch_img = Image.fromarray(patch_arr)
-            patch_img.save(os.path.join(output_dir, out_file_name))
             n_saved += 1
-        
-        n_total += 1
+
+        if saved_patches:
+            cells = run.cells[saved]
+            store.append(saved_patches, 
+                         slide=[slide_name] * len(saved), 
+                         row=cells['row'], 
+                         col=cells['col'], 
+                         x=cells['x'], 
+                         y=cells['y'], 
+                         level=[run.level] * len(saved), 
+                         white_perc=saved_white_percs)
+
+    if output == 'hdf5':
+        store.close()
 
     return n_total, n_saved
 
 
+# Slides opened by each worker process
+_worker_slides = {}
+
+
+def _open_worker_slide(slide_file):
+
+    if slide_file not in _worker_slides:
+        _worker_slides.clear()
+        _worker_slides[slide_file] = openslide.open_slide(slide_file)
+
+    return _worker_slides[slide_file]
+
+
+def _slide_row_shards(slide_file, patch_size, magnification, shards, catalog=None):
+
+    if shards <= 1:
+        return [None]
+
+    # The catalog has the slide geometry without opening the file
+    slide_info = catalog.get(os.path.basename(slide_file)) if catalog is not None else None
+    os_img = slide_info if slide_info is not None else openslide.open_slide(slide_file)
+    _, _, level_patch_size, _, _, level_height = _get_level_params(os_img, patch_size, magnification)
+    if slide_info is None:
+        os_img.close()
+
+    n_rows = int(round(level_height / level_patch_size))
+    bounds = np.linspace(0, n_rows, min(shards, max(n_rows, 1)) + 1).astype(int)
+
+    return [(start, stop) for start, stop in zip(bounds[:-1], bounds[1:])]
+
+
+def _patch_slide_task(task, output_dir, patch_size, magnification, white_pixel_thresh, sampling, 
+                      white_max_value, mask_margin, output):
+
+    slide_file, rows = task
+
+    # Forked workers would otherwise share the same random state
+    np.random.seed()
+
+    os_img = _open_worker_slide(slide_file)
+    n_patches, n_valid_patches = patch_slide(os_img, output_dir, patch_size, magnification, 
+                                             white_pixel_thresh, sampling, white_max_value, rows, 
+                                             mask_margin, output=output)
+
+    return slide_file, n_patches, n_valid_patches
+
+
 def patch_slides(slide_files, output_dir, patch_size, magnification, 
-                 white_pixel_thresh=20, sampling=1, white_max_value=220):
+                 white_pixel_thresh=20, sampling=1, white_max_value=220, workers=1, shards=1, 
+                 mask_margin=10, output='png', catalog=None):
+    """
+    Patches a list of slides. With workers > 1 the slides, split in shards of grid rows, 
+    are distributed across a pool of processes, each with its own OpenSlide handles. The 
+    shards are planned from the SlideCatalog if given.
+    """
 
     if isinstance(slide_files, pd.Series):
         slide_files = slide_files.values
 
+    counts = OrderedDict((slide_file, [0, 0]) for slide_file in slide_files)
+
+    if workers <= 1:
+        for slide_file in tqdm(slide_files):
+                
+            os_img = openslide.open_slide(slide_file)
+            n_patches, n_valid_patches = patch_slide(os_img, output_dir, patch_size, magnification, 
+                                                     white_pixel_thresh, sampling, white_max_value, 
+                                                     mask_margin=mask_margin, output=output)
+            counts[slide_file] = [n_patches, n_valid_patches]
+    else:
+        tasks = [(slide_file, rows) for slide_file in slide_files 
+                 for rows in _slide_row_shards(slide_file, patch_size, magnification, shards, 
+                                               catalog)]
+
+        func = partial(_patch_slide_task, output_dir=output_dir, patch_size=patch_size, 
+                       magnification=magnification, white_pixel_thresh=white_pixel_thresh, 
+                       sampling=sampling, white_max_value=white_max_value, mask_margin=mask_margin, 
+                       output=output)
+
+        with Pool(processes=workers) as pool:
+            for slide_file, n_patches, n_valid_patches in tqdm(pool.imap_unordered(func, tasks), 
+                                                               total=len(tasks)):
+                counts[slide_file][0] += n_patches
+                counts[slide_file][1] += n_valid_patches
+
     results = []
-    for slide_file in tqdm(slide_files):
-            
-        os_img = openslide.open_slide(slide_file)
-        n_patches, n_valid_patches = patch_slide(os_img, output_dir, patch_size, magnification, 
-                                                 white_pixel_thresh, sampling, white_max_value)
-        
+    for slide_file, (n_patches, n_valid_patches) in counts.items():
         results.append({'file':slide_file.rsplit('/', 1)[-1], 
                         'total_patches': n_patches, 
                         'saved_patches': n_valid_patches, 
@@ -130,4 +413,4 @@ def patch_slides(slide_files, output_dir, patch_size, magnification,
 
     results = pd.DataFrame(results)[['file', 'total_patches', 'saved_patches', 'perc_saved_patches']]
 
-    return results
\ No newline at end of file
+    return results
@@ -2,6 +2,8 @@ import PIL
 import numpy as np
 import openslide
 
+from wsi.filter import rgb_to_gray
+
 def thumbnail(openslide_img, max_size=512, resample=PIL.Image.LANCZOS):
 
     level = openslide_img.level_count - 1
@@ -17,6 +19,17 @@ def thumbnail(openslide_img, max_size=512, resample=PIL.Image.LANCZOS):
     return img 
     
 
+def tissue_mask(openslide_img, white_max_value=220):
+    """
+    Boolean mask of the non white pixels of the lowest resolution level of the slide.
+    """
+
+    level_width, level_height = openslide_img.level_dimensions[-1]
+    img = thumbnail(openslide_img, max_size=max(level_width, level_height))
+
+    return rgb_to_gray(np.asarray(img.convert('RGB'))) < white_max_value
+
+
 def downsample(openslide_img, scale_factor, output_format='image'):
 
     level = openslide_img.get_best_level_for_downsample(scale_factor)
@@ -0,0 +1,90 @@
+import h5py
+import numpy as np
+import pandas as pd
+
+STORE_EXT = '.h5'
+
+INDEX_COLUMNS = {'slide': 'S64', 
+                 'row': 'int32', 
+                 'col': 'int32', 
+                 'x': 'int64', 
+                 'y': 'int64', 
+                 'level': 'int8', 
+                 'white_perc': 'float32'}
+
+
+class PatchStore(object):
+    """
+    HDF5 store of patches: a chunked and compressed uint8 'patches' array (n, h, w, 3) plus 
+    one dataset per index column (slide, grid row and col, location, level and white 
+    percentage). Supports appending and random or sliced reads.
+    """
+
+    def __init__(self, path, mode='r', chunk_size=64, compression='lzf'):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.file = h5py.File(path, mode)
+
+    def _create(self, patch_shape):
+
+        self.file.create_dataset('patches', shape=(0,) + patch_shape, maxshape=(None,) + patch_shape, 
+                                 dtype='uint8', chunks=(self.chunk_size,) + patch_shape, 
+                                 compression=self.compression)
+
+        for column, dtype in INDEX_COLUMNS.items():
+            self.file.create_dataset(column, shape=(0,), maxshape=(None,), dtype=dtype, 
+                                     chunks=(self.chunk_size * 16,))
+
+    def append(self, patches, **index):
+
+        patches = np.asarray(patches, dtype='uint8')
+
+        if 'patches' not in self.file:
+            self._create(patches.shape[1:])
+
+        start, end = len(self), len(self) + len(patches)
+
+        for name in ['patches'] + list(INDEX_COLUMNS):
+            self.file[name].resize(end, axis=0)
+
+        self.file['patches'][start:end] = patches
+        for column in INDEX_COLUMNS:
+            self.file[column][start:end] = index[column]
+
+    def __len__(self):
+        return self.file['patches'].shape[0] if 'patches' in self.file else 0
+
+    def __getitem__(self, idx):
+
+        if isinstance(idx, (slice, int, np.integer)):
+            return self.file['patches'][idx]
+
+        # HDF5 fancy indexing needs increasing indices
+        idx = np.asarray(idx)
+        order = np.argsort(idx)
+        unique_idx, inverse = np.unique(idx[order], return_inverse=True)
+
+        patches = np.empty((len(idx),) + self.file['patches'].shape[1:], dtype='uint8')
+        patches[order] = self.file['patches'][unique_idx][inverse]
+
+        return patches
+
+    def index(self):
+
+        if len(self) == 0:
+            return pd.DataFrame(columns=list(INDEX_COLUMNS))
+
+        index_df = pd.DataFrame({column: self.file[column][:] for column in INDEX_COLUMNS})
+        index_df['slide'] = index_df['slide'].str.decode('utf-8')
+
+        return index_df
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -11,6 +11,7 @@ except:
 
 from wsi.slide import thumbnail
 from wsi.patch import patch_slides
+from wsi.catalog import SlideCatalog, CATALOG_FILE
 
 def main(args):
 
@@ -22,6 +23,13 @@ def main(args):
     slides_df = pd.read_csv(os.path.join(conf['data_path'], 'slides_metadata.csv'), sep='|')
     slides_df = slides_df[slides_df['file_name'].isin(os.listdir(slides_path))]
 
+    # Slide geometry, only re-read for new or modified slides
+    catalog = SlideCatalog(os.path.join(conf['data_path'], CATALOG_FILE))
+    catalog.refresh(slides_path, slides_df['file_name'].values)
+    slides_df = catalog.to_dataframe(slides_df)
+    # The magnification is needed to plan the patches
+    slides_df = slides_df[slides_df['app_mag'].notnull()]
+
     # Thumbnails
     if args.thumbnails:
 
@@ -29,10 +37,13 @@ def main(args):
         if not os.path.exists(thumbnails_path):
             os.mkdir(thumbnails_path)
 
-        for slide_file in tqdm(slides_df['file_name'].values, unit='file'):
+        for slide_file, mtime in tqdm(slides_df[['file_name', 'mtime']].values, unit='file'):
+            thumbnail_file = os.path.join(thumbnails_path, slide_file.replace('.svs', '.png'))
+            if os.path.exists(thumbnail_file) and os.path.getmtime(thumbnail_file) >= mtime:
+                continue
             os_img = openslide.open_slide(os.path.join(slides_path, slide_file))
             img = thumbnail(os_img, max_size=conf['wsi']['thumbnail_size'])
-            img.save(os.path.join(thumbnails_path, slide_file.replace('.svs', '.png')))
+            img.save(thumbnail_file)
 
     # Patches
     patches_path = os.path.join(conf['data_path'], 'slides', 'patches')
@@ -44,7 +55,11 @@ def main(args):
                                     conf['wsi']['patch_size'], 
                                     conf['wsi']['magnification'], 
                                     conf['wsi']['white_pixel_threshold'], 
-                                    conf['wsi']['sampling'])
+                                    conf['wsi']['sampling'], 
+                                    workers=args.workers, 
+                                    shards=args.shards, 
+                                    output=args.output, 
+                                    catalog=catalog)
     
     patching_results.to_csv(os.path.join(conf['data_path'], 'patching_results.csv'), sep='|', index=False)
 
@@ -54,6 +69,11 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser("WSI Patching")
     parser.add_argument('-conf', help="Path to config file", type=str, default='conf/user_conf.yaml')
     parser.add_argument('-thumbnails', help="Create thumbail .png images", type=bool, default=True)
+    parser.add_argument('-workers', help="Number of processes to patch slides in parallel", type=int, default=1)
+    parser.add_argument('-output', help="Patches output: one png per patch or an hdf5 store per slide", 
+                        type=str, choices=['png', 'hdf5'], default='png')
+    parser.add_argument('-shards', help="Number of row shards each slide is split in (with -workers)", 
+                        type=int, default=1)
 
     args = parser.parse_args()
 